@@ -5,10 +5,22 @@ https://integrations.expensify.com/Integration-Server/doc/
 
 Copyright 2017-2025 FinOptimal, Inc. All rights reserved.
 """
+import contextlib
+import cProfile
+import datetime
+import hashlib
 import json
+import os
+import pstats
 import re
 import requests
+import threading
 import time
+import tracemalloc
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.exceptions import ReadTimeoutError
 
 from finoptimal.logging import get_file_logger
 from finoptimal.utilities import informed_sleep
@@ -38,20 +50,304 @@ DEFAULT_JSON_TEMPLATE = """
 
 SELF_THROTTLE_SECS = 4
 
-def post(data, files=None, timeout=60):
-    informed_sleep(SELF_THROTTLE_SECS, narrative="Stay below 50-request / minute limit!", verbosity=api_logger.vb)
-    resp = requests.post(url=URL, data=data, files=files, timeout=timeout)
+# Requests from concurrent threads are spaced SELF_THROTTLE_SECS apart
+THROTTLE_LOCK = threading.Lock()
+THROTTLE_SLOT = [0.0]
+
+# How many profiled calls are using tracemalloc, and whether they started it
+PROFILING_LOCK = threading.Lock()
+TRACEMALLOC_USERS = {"count": 0, "started": False}
+# Whether a profiled call (on any thread) is running cProfile; only one can
+#  at a time on Python 3.12+
+PROFILER_BUSY = [False]
+
+# Exports of closed periods (end_date more than CACHE_FREEZE_DAYS in the
+#  past) can be served from a local download cache if a cache_dir is given.
+CACHE_FREEZE_DAYS = 60
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Only files named like this (a cache_key plus extension) are ever evicted
+CACHE_FILE_PATTERN = re.compile(r"^[0-9a-f]{64}\.\w+$")
+
+EXPORT_TIMEOUT_SECS = 240
+# 500 responses only count as "too large" if their message is about size
+#  (or the server timing out), not e.g. "Rate limit exceeded"
+SIZE_ERROR_PATTERN = re.compile(
+    r"too (large|big|many)|(file|export|response|memory|size) (size )?(limit|exceed)"
+    r"|exceeds? (the )?(max|size)|timed? ?out", re.I)
+# Adaptive exports never start with more pieces than this
+MAX_INITIAL_PIECES = 32
+
+# Per-tenant sizes and durations of past exports, used by adaptive exports
+#  to pick an initial split. Persisted to a history_path if one is given.
+EXPORT_HISTORY = {}
+EXPORT_HISTORY_LENGTH = 50
+EXPORT_HISTORY_LOCK = threading.Lock()
+
+# Longer reportIDList / policyIDList filters are split into jobs of at most
+#  this many IDs, EXPORT_WORKERS of which run at a time.
+MAX_REPORT_IDS_PER_JOB = 500
+MAX_POLICY_IDS_PER_JOB = 50
+EXPORT_WORKERS = 4
+
+JOURNAL_LOCK = threading.Lock()
+
+# Literal colons in tag names, as cleansed exports carry them
+ESCAPED_COLON = "|||||"
+POLICY_IDS_PER_REQUEST = 20
+# Signs, in get_policies output, that a policy's tag levels depend on each
+#  other: a truthy level key like "dependent" or "isDependent", a tag key like
+#  "parent" or "parentTagName", or tags below the first level named by their
+#  full path ("East:Sales"). Expensify doesn't document the keys, so they're
+#  matched loosely.
+DEPENDENT_LEVEL_KEY_PATTERN = re.compile(r"depend", re.I)
+PARENT_TAG_KEY_PATTERN = re.compile(r"parent", re.I)
+
+# Export archives: <root>/policy=<policyID>/month=<yyyy-mm>/part-*.<format>
+ARCHIVE_FORMATS = {"parquet": "parquet", "feather": "ipc"}
+# ...so rows can't have columns of these names
+ARCHIVE_PARTITION_FIELDS = ("policy", "month")
+# Formats date_field values are parsed with (ISO first), for their month
+ARCHIVE_DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%Y/%m/%d", "%m/%d/%y")
+# Every part file is written with this (underscored, so dataset discovery
+#  skips it) archive-wide schema, widened as new columns or types show up
+ARCHIVE_SCHEMA_FILE = "_schema.arrow"
+
+
+class ExportTooLarge(Exception):
+    """
+    An export timed out or was rejected by Expensify in a way that suggests
+     it's too big; trying the very same job again won't help.
+    """
+
+
+class MarkStateUnknown(Exception):
+    """
+    A journaled export with an export_mark was submitted but never got a file
+     name back, so Expensify may already have marked its reports. Exporting
+     it again could silently come back without them.
+    """
+
+
+class DependentTagsUnresolved(Exception):
+    """
+    A policy's tag levels depend on each other, but its get_policies output
+     doesn't say which parent some of its tags belong under, so none of its
+     tags can be checked.
+    """
+
+
+class PartialExport(Exception):
+    """
+    Some chunks of an export failed. results holds the rows of those that
+     succeeded (and may already have marked their reports); errors holds
+     what the others raised.
+    """
+    def __init__(self, results, errors):
+        super().__init__(f"{len(errors)} export chunk(s) failed, first with: {errors[0]!r}")
+        self.results = results
+        self.errors = errors
+
+
+class CallTrace:
+    """
+    Where the time (and bytes) went during one call. Pass trace=CallTrace()
+     to any of the job functions and inspect trace.spans (or print it)
+     afterwards. With profile=True, the whole call also gets cProfile stats
+     (trace.stats, a pstats.Stats) and its tracemalloc peak (in bytes).
+
+    Spans are recorded from every thread. Only one profiled call at a time
+     gets cProfile stats, process-wide: one that starts while another is
+     being profiled (or while some other profiler is running) leaves
+     trace.stats as None. Before Python 3.12 cProfile only sees the thread
+     that made the call, so when chunks or policy batches run on worker
+     threads trace.stats shows it waiting on them; from 3.12 on it sees
+     every thread, unrelated ones included. The tracemalloc peak is always
+     process-wide, so it includes the workers (and anything else running at
+     the time).
+
+    Phases are throttle, build job, server wait (which includes uploading
+     the request), download, cache read, cleanse and parse.
+    """
+    def __init__(self, profile=False):
+        self.profile = profile
+        self.spans = []
+        self.stats = None
+        self.peak_memory = None
+        self._profiling = False
+
+    def record(self, phase, secs, nbytes=None):
+        self.spans.append({"phase": phase, "secs": secs, "bytes": nbytes})
+
+    @contextlib.contextmanager
+    def span(self, phase, nbytes=None):
+        # Yields the span so its byte count can be filled in once known
+        span = {"phase": phase, "secs": None, "bytes": nbytes}
+        st = time.time()
+
+        try:
+            yield span
+        finally:
+            span["secs"] = time.time() - st
+            self.spans.append(span)
+
+    @contextlib.contextmanager
+    def profiling(self):
+        with PROFILING_LOCK:
+            nested = self._profiling
+            self._profiling = True
+
+            if not nested:
+                if TRACEMALLOC_USERS["count"] == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    TRACEMALLOC_USERS["started"] = True
+
+                TRACEMALLOC_USERS["count"] += 1
+                tracemalloc.reset_peak()
+
+                owns_profiler = not PROFILER_BUSY[0]
+                PROFILER_BUSY[0] = True
+
+        if nested:
+            # e.g. export_and_download_reports -> export_and_download_job,
+            #  or a worker thread of an already-profiled call
+            yield
+            return
+
+        profiler = None
+
+        if owns_profiler:
+            profiler = cProfile.Profile()
+
+            try:
+                profiler.enable()
+            except ValueError:
+                # "Another profiling tool is already active", e.g. a debugger
+                profiler = None
+
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+            with PROFILING_LOCK:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+                TRACEMALLOC_USERS["count"] -= 1
+
+                # Only the last profiled call out stops tracemalloc, and only
+                #  if one of them started it
+                if TRACEMALLOC_USERS["count"] == 0 and TRACEMALLOC_USERS["started"]:
+                    tracemalloc.stop()
+                    TRACEMALLOC_USERS["started"] = False
+
+                if owns_profiler:
+                    PROFILER_BUSY[0] = False
+
+                self._profiling = False
+
+            if profiler is not None:
+                self.stats = pstats.Stats(profiler)
+
+    def totals(self):
+        """
+        Seconds, bytes and span counts per phase.
+        """
+        totals = {}
+
+        for span in self.spans:
+            total = totals.setdefault(span["phase"], {"secs": 0.0, "bytes": 0, "count": 0})
+            total["secs"] += span["secs"] or 0.0
+            total["bytes"] += span["bytes"] or 0
+            total["count"] += 1
+
+        return totals
+
+    def __str__(self):
+        lines = [f"{phase:<12} {total['secs']:>9,.2f}s {total['bytes']:>14,} bytes ({total['count']}x)"
+                 for phase, total in self.totals().items()]
+
+        if self.peak_memory is not None:
+            lines.append(f"{'peak memory':<12} {self.peak_memory:>25,} bytes")
+
+        return "\n".join(lines)
+
+
+def trace_span(trace, phase, nbytes=None):
+    """
+    trace.span(...) if there's a trace, else a do-nothing context manager.
+    """
+    if trace is None:
+        return contextlib.nullcontext({})
+
+    return trace.span(phase, nbytes)
+
+
+def traced(function):
+    """
+    Profiles the whole call (retries included) if it's passed
+     trace=CallTrace(profile=True).
+    """
+
+    def inner(*args, **kwargs):
+        trace = kwargs.get("trace")
+
+        if trace is None or not trace.profile:
+            return function(*args, **kwargs)
+
+        with trace.profiling():
+            return function(*args, **kwargs)
+
+    return inner
+
+
+def throttle_secs():
+    """
+    How long the calling thread must wait for its turn. Each request waits
+     SELF_THROTTLE_SECS after the last one (from any thread) went out, so
+     concurrent jobs still stay under the rate limit.
+    """
+    with THROTTLE_LOCK:
+        now = time.time()
+        THROTTLE_SLOT[0] = max(now, THROTTLE_SLOT[0]) + SELF_THROTTLE_SECS
+
+        return THROTTLE_SLOT[0] - now
+
+
+def post(data, files=None, timeout=60, trace=None):
+    with trace_span(trace, "throttle"):
+        informed_sleep(throttle_secs(), narrative="Stay below 50-request / minute limit!", verbosity=api_logger.vb)
+
+    sent_bytes = sum(len(str(value).encode("utf-8")) for value in data.values())
+
+    with trace_span(trace, "server wait", sent_bytes):
+        # When tracing, only the headers come back here so the transfer of
+        #  the body can be timed separately
+        resp = requests.post(url=URL, data=data, files=files, timeout=timeout,
+                             stream=trace is not None)
+
+    if trace is not None:
+        with trace_span(trace, "download") as span:
+            try:
+                span["bytes"] = len(resp.content)
+            except requests.exceptions.ConnectionError as e:
+                # Streamed bodies report read timeouts as connection errors;
+                #  callers (e.g. adaptive exports) rely on seeing a Timeout
+                if e.args and isinstance(e.args[0], ReadTimeoutError):
+                    raise requests.exceptions.ReadTimeout(e) from e
+                raise
 
     api_logger.info(f"{resp.__hash__()} - {resp.status_code} {resp.reason} - "
                     f"{resp.request.method.ljust(4)} {resp.url}")
     return resp
 
 
-def retry(max_tries=3, delay_secs=1):
+def retry(max_tries=3, delay_secs=1, fatal_exceptions=()):
     """
     Produces a decorator which tries effectively the function it decorates
      a given number of times. This is meant to (considerately) address
      occassional, transient unexpected behavior by the Expensify API.
+
+    fatal_exceptions are re-raised immediately, without retrying.
     """
 
     def decorator(retriable_function):
@@ -70,6 +366,8 @@ def retry(max_tries=3, delay_secs=1):
             while True:
                 try:
                     return retriable_function(*args, **kwargs)
+                except fatal_exceptions:
+                    raise
                 except:
                     tries -= 1
                     attempts += 1
@@ -85,18 +383,305 @@ def retry(max_tries=3, delay_secs=1):
     return decorator
 
 
+def cache_key(job_description, template=None, partner_user_id=None):
+    """
+    A content address for an export: the hash of the (credential-free)
+     requestJobDescription and template. The partnerUserID (never the
+     secret) is mixed in so that two tenants running the same job don't
+     share each other's downloads.
+    """
+    normalized = json.dumps(job_description, sort_keys=True, separators=(",", ":"))
+    hasher = hashlib.sha256()
+
+    for part in (partner_user_id or "", normalized, template or ""):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")
+
+    return hasher.hexdigest()
+
+
+def is_frozen(end_date, freeze_days=CACHE_FREEZE_DAYS):
+    """
+    Is the period ending on end_date old enough that its export won't change?
+    """
+    if not end_date:
+        return False
+
+    end = datetime.date.fromisoformat(str(end_date)[:10])
+
+    return end < datetime.date.today() - datetime.timedelta(days=freeze_days)
+
+
+def read_cached_download(cache_dir, key, file_extension):
+    """
+    Returns the cached bytes for key (or None), refreshing the entry's
+     mtime so eviction is least-recently-used.
+    """
+    path = os.path.join(cache_dir, f"{key}.{file_extension}")
+
+    try:
+        with open(path, "rb") as cache_handle:
+            payload = cache_handle.read()
+    except OSError:
+        return None
+
+    os.utime(path)
+    return payload
+
+
+def write_cached_download(cache_dir, key, file_extension, payload,
+                          max_bytes=CACHE_MAX_BYTES):
+    """
+    Atomically stores payload under key, then evicts the least-recently-used
+     entries until the cache fits in max_bytes. Other files that happen to
+     be in cache_dir are neither counted nor touched.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{key}.{file_extension}")
+    temp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(temp_path, "wb") as cache_handle:
+        cache_handle.write(payload)
+
+    os.replace(temp_path, path)
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and CACHE_FILE_PATTERN.match(entry.name):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+
+    for _, size, entry_path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+
+        try:
+            os.remove(entry_path)
+        except OSError:
+            continue
+
+        total_bytes -= size
+
+
+def as_id_list(ids):
+    """
+    Report and policy IDs come in as comma-separated strings, single numbers
+     or lists; this makes them a list of strings.
+    """
+    if not ids:
+        return []
+
+    if isinstance(ids, str):
+        ids = ids.split(",")
+    elif isinstance(ids, (float, int)):
+        # i.e. just a single report
+        ids = [ids]
+
+    return [str(id_).strip() for id_ in ids]
+
+
+def read_journal(journal_path):
+    """
+    The latest state of every job in the export journal, keyed by job.
+    """
+    jobs = {}
+
+    if not os.path.exists(journal_path):
+        return jobs
+
+    with open(journal_path) as journal_handle:
+        for line in journal_handle:
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line torn by a crash mid-write
+                continue
+
+            jobs.setdefault(record["job"], {}).update(record)
+
+    return jobs
+
+
+def append_journal(journal_path, **record):
+    """
+    Durably appends a record (job, state and whatever else is known) to the
+     export journal before anything that depends on it happens.
+    """
+    record["at"] = time.time()
+    line = json.dumps(record) + "\n"
+
+    with JOURNAL_LOCK:
+        with open(journal_path, "a+b") as journal_handle:
+            if journal_handle.seek(0, os.SEEK_END):
+                journal_handle.seek(-1, os.SEEK_END)
+
+                if journal_handle.read(1) != b"\n":
+                    # The last line was torn by a crash mid-write; don't glue
+                    #  this record onto it
+                    line = "\n" + line
+
+            journal_handle.write(line.encode("utf-8"))
+            journal_handle.flush()
+            os.fsync(journal_handle.fileno())
+
+
+def is_error_response(rj):
+    """
+    Is this parsed download actually one of Expensify's error responses?
+    """
+    return isinstance(rj, dict) and rj.get("responseCode", 200) != 200
+
+
+def parse_export(payload, clear_bad_escapes=True, encoding="utf-8", trace=None):
+    """
+    Turns a downloaded json export into Python objects.
+    """
+    text = payload.decode(encoding)
+
+    if clear_bad_escapes:
+        # Expensify uses colons as tag delimimters. If there's a colon in
+        #  the tag name, it "escapes" them with a backslash. That backslash,
+        #  which makes for invalid json because it's not actually escaping
+        #  anything, will blow up json.loads, so it needs to get gone.
+        # We don't turn \: into just :, though, because then a downstream
+        #  process can't tell if it's supposed to be a delimiter or a
+        #  literal colon. Instead, we make it something that a downstream
+        #  process is VERY unlikely to mistake for anything but a colon...
+        with trace_span(trace, "cleanse", len(payload)):
+            text = re.sub(r"\\\\*:", "|||||", text)
+        # colon_cleansed_rj = resp2.text.replace("\\:", "|||||") #65403
+
+    with trace_span(trace, "parse", len(payload)):
+        return json.loads(text)
+
+
+@traced
 @retry()
-def export_and_download_reports(
+def download_export(file_name, file_extension="json", download_path=None,
+                    clear_bad_escapes=True, trace=None, verbosity=0,
+                    **credentials):
+    """
+    https://integrations.expensify.com/Integration-Server/doc/#downloader
+
+    Downloads (and parses, unless it's a pdf) a file an export job
+     generated earlier.
+    """
+    rjd = {
+        "type": "download",
+        "credentials": credentials,
+        "fileName": file_name
+    }
+
+    data = {
+        "requestJobDescription": json.dumps(rjd, indent=4)
+    }
+
+    # Start Time
+    st = time.time()
+    resp = post(data=data, timeout=EXPORT_TIMEOUT_SECS, trace=trace)
+    # Call Time
+    ct = time.time() - st
+
+    if verbosity > 2:
+        print(f"Expensify {rjd['type']} of {file_name} call response status code: {resp.status_code} "
+              f"({ct:,.0f} seconds)")
+
+    if file_extension.replace(".", "").lower() == "pdf":
+        with open(download_path, 'wb') as destination_handle:
+            destination_handle.write(resp.content)
+
+        return download_path
+
+    return parse_export(resp.content, clear_bad_escapes=clear_bad_escapes,
+                        encoding=resp.encoding or "utf-8", trace=trace)
+
+
+def resume_pending_downloads(journal_path, trace=None, verbosity=0, **credentials):
+    """
+    After a crash, downloads every journaled export (for these credentials)
+     that got its reports marked but never finished downloading. Returns
+     {job: result}, the same results export_and_download_job would have.
+
+    Jobs that were submitted but never got a file name back are reported,
+     not retried: Expensify may or may not have marked their reports.
+    """
+    results = {}
+
+    for job_key, job in read_journal(journal_path).items():
+        if job.get("partner_user_id") != credentials.get("partnerUserID"):
+            continue
+
+        if job["state"] == "submitted":
+            print(f"Expensify export {job_key} (mark {job.get('mark')}) never returned a file "
+                  f"name; check whether its reports were marked!")
+
+        if job["state"] != "exported":
+            continue
+
+        results[job_key] = download_export(
+            job["file_name"], file_extension=job.get("file_extension", "json"),
+            download_path=job.get("download_path"),
+            clear_bad_escapes=job.get("clear_bad_escapes", True), trace=trace,
+            verbosity=verbosity, **credentials)
+
+        append_journal(journal_path, job=job_key, state="done")
+
+    return results
+
+
+@retry()
+def fetch_download(data, trace=None):
+    """
+    The download half of an export job. The file already exists by the time
+     this is called, so a timeout here is retried on its own rather than
+     treated as the export being too large.
+    """
+    return post(data=data, timeout=EXPORT_TIMEOUT_SECS, trace=trace)
+
+
+@traced
+@retry(fatal_exceptions=(ExportTooLarge, MarkStateUnknown))
+def export_and_download_job(
         report_states=None, limit=None, report_ids=None, policy_ids=None,
         start_date=None, end_date=None, approved_after=None,
         export_mark_filter=None, export_mark=None,
         file_base_name="fo_exp_", file_extension="json", download_path=None,
-        template=None, clear_bad_escapes=True, verbosity=0, **credentials):
+        template=None, clear_bad_escapes=True, cache_dir=None,
+        freeze_days=CACHE_FREEZE_DAYS, journal_path=None,
+        raise_if_too_large=False, export_timing=None, trace=None, verbosity=0,
+        **credentials):
     """
     https://integrations.expensify.com/Integration-Server/doc/#report-exporter
 
-    returns a file name you pass to the downloader endpoint to get the file
+    A single export job plus the download of the file it generates. Most
+     callers want export_and_download_reports, which may split the work
+     into several of these.
+
+    If raise_if_too_large, a read timeout of the export request, or a 500
+     response whose message is about size, raises ExportTooLarge (which
+     isn't retried) so the caller can split the job. If export_timing (a
+     dict) is given, its "secs" is set to how long Expensify took to
+     generate the file, or None if the file came from the cache or journal.
+
+    If cache_dir is given, exports of periods that ended more than
+     freeze_days ago (and that neither mark anything as exported nor filter
+     on export marks) are served from, and saved to, a content-addressed
+     cache in that directory.
+
+    If journal_path is given, jobs with an export_mark are journaled there
+     before the reports get marked, and a repeat of a job whose download
+     never finished just downloads the file it already generated (see
+     resume_pending_downloads). A repeat (or retry) of a job that never got
+     a file name back raises MarkStateUnknown instead of exporting again.
     """
+    # Build Time
+    bt = time.time()
+
     rjd = {
         "type": "file",
         "credentials": credentials,
@@ -131,19 +716,10 @@ def export_and_download_reports(
         rjd["inputSettings"]["filters"]["approvedAfter"] = str(approved_after)
 
     if report_ids:
-        if isinstance(report_ids, str):
-            report_ids = report_ids.split(",")
-        elif isinstance(report_ids, (float, int)):
-            # i.e. just a single report
-            report_ids = [ report_ids ]
-
-        rjd["inputSettings"]["filters"]["reportIDList"] = ",".join(report_ids)
+        rjd["inputSettings"]["filters"]["reportIDList"] = ",".join(as_id_list(report_ids))
 
     if policy_ids:
-        if isinstance(policy_ids, str):
-            policy_ids = policy_ids.split(",")
-
-        rjd["inputSettings"]["filters"]["policyIDList"] = ",".join(policy_ids)
+        rjd["inputSettings"]["filters"]["policyIDList"] = ",".join(as_id_list(policy_ids))
 
     if export_mark_filter:
         rjd["inputSettings"]["filters"]["markedAsExported"] = export_mark_filter
@@ -173,96 +749,513 @@ def export_and_download_reports(
     del (vjd["credentials"])
     dumped_vjd = json.dumps(vjd, indent=4)
 
+    if trace is not None:
+        trace.record("build job", time.time() - bt, len(data["requestJobDescription"]))
+
     if verbosity > 2:
         print("Expensify JobDescription (sans creds):")
         print(dumped_vjd)
 
-    # Start Time
-    st = time.time()
-    resp = post(data=data, timeout=240)
-    # Call Time
-    ct = time.time() - st
+    extension = file_extension.replace(".", "").lower()
+    key = None
+    payload = None
+
+    if export_timing is not None:
+        export_timing["secs"] = None
+
+    # A markedAsExported filter's results keep shrinking as other jobs mark
+    #  reports, however old the period, so those are never cached either
+    if (cache_dir and not export_mark and not export_mark_filter
+            and is_frozen(end_date, freeze_days)):
+        key = cache_key(vjd, template, credentials.get("partnerUserID"))
+
+        with trace_span(trace, "cache read") as span:
+            payload = read_cached_download(cache_dir, key, extension)
+            span["bytes"] = len(payload or b"")
+
+        if verbosity > 2 and payload is not None:
+            print(f"Expensify export served from cache: {key} ({len(payload):,} bytes)")
+
+    job_key = None
+    # Cached payloads are always stored as utf-8
+    encoding = "utf-8"
+
+    if payload is None:
+        file_name = None
+
+        if journal_path and export_mark:
+            job_key = cache_key(vjd, template, credentials.get("partnerUserID"))
+            pending = read_journal(journal_path).get(job_key, {})
+
+            if pending.get("state") == "exported":
+                # A previous attempt got as far as marking the reports, so
+                #  exporting again would come back without them.
+                file_name = pending["file_name"]
+
+                if verbosity > 2:
+                    print(f"Expensify export resumed from journal: {file_name}")
+
+            elif pending.get("state") == "submitted":
+                # e.g. the export request timed out (maybe after marking)
+                raise MarkStateUnknown(
+                    f"Expensify export {job_key} (mark {export_mark}) was submitted but never "
+                    f"returned a file name. Check whether its reports were marked, re-export them "
+                    f"if so, then record that with append_journal({journal_path!r}, "
+                    f"job={job_key!r}, state=\"abandoned\").")
+
+            else:
+                append_journal(
+                    journal_path, job=job_key, state="submitted",
+                    partner_user_id=credentials.get("partnerUserID"),
+                    mark=export_mark, file_extension=extension,
+                    download_path=download_path,
+                    clear_bad_escapes=clear_bad_escapes, job_description=vjd)
+
+        if not file_name:
+            # Start Time
+            st = time.time()
+            try:
+                resp = post(data=data, timeout=EXPORT_TIMEOUT_SECS, trace=trace)
+            except requests.exceptions.ReadTimeout as e:
+                # Connect timeouts say nothing about size, so they're retried
+                if raise_if_too_large:
+                    raise ExportTooLarge(dumped_vjd) from e
+                raise
+            # Call Time
+            ct = time.time() - st
+
+            if export_timing is not None:
+                # Until the response came back, so without the throttle
+                export_timing["secs"] = resp.elapsed.total_seconds()
+
+            if verbosity > 6:
+                print(resp.text)
+
+            if verbosity > 2:
+                print(f"Expensify {rjd['inputSettings']['type']} {rjd['type']} call response status code: "
+                      f"{resp.status_code} ({ct:,.0f} seconds)")
+
+            if resp.text[0] == "{" and resp.json().get("responseCode") == 500:
+                msg = "\n\n".join([dumped_vjd, resp.text])
+                response_message = str(resp.json().get("responseMessage", ""))
+
+                if job_key:
+                    append_journal(journal_path, job=job_key, state="failed")
+
+                if raise_if_too_large and SIZE_ERROR_PATTERN.search(response_message):
+                    raise ExportTooLarge(msg)
+                raise Exception(msg)
+
+            file_name = resp.text
+
+            if job_key:
+                append_journal(journal_path, job=job_key, state="exported", file_name=file_name)
+
+        rjd2 = {
+            "type": "download",
+            "credentials": credentials,
+            "fileName": file_name
+        }
 
-    if verbosity > 6:
-        print(resp.text)
+        data2 = {
+            "requestJobDescription": json.dumps(rjd2, indent=4)
+        }
 
-    if verbosity > 2:
-        print(f"Expensify {rjd['inputSettings']['type']} {rjd['type']} call response status code: "
-              f"{resp.status_code} ({ct:,.0f} seconds)")
+        if verbosity > 2:
+            print("Expensify JobDescription (sans creds):")
+            vjd2 = rjd2.copy()
+            del (vjd2["credentials"])
+            print(json.dumps(vjd2, indent=4))
 
-    if resp.text[0] == "{" and resp.json().get("responseCode") == 500:
-        msg = "\n\n".join([dumped_vjd, resp.text])
-        raise Exception(msg)
+        # Start Time
+        st = time.time()
+        resp2 = fetch_download(data2, trace=trace)
+        # Call Time
+        ct = time.time() - st
 
-    rjd2 = {
-        "type": "download",
-        "credentials": credentials,
-        "fileName": resp.text
-    }
+        payload = resp2.content
+        encoding = resp2.encoding or "utf-8"
 
-    data2 = {
-        "requestJobDescription": json.dumps(rjd2, indent=4)
-    }
+        if resp2.status_code != 200:
+            # Don't serve an error from the cache forever
+            key = None
 
-    if verbosity > 2:
-        print("Expensify JobDescription (sans creds):")
-        vjd2 = rjd2.copy()
-        del (vjd2["credentials"])
-        print(json.dumps(vjd2, indent=4))
+        if verbosity > 2:
+            print(f"Expensify {rjd2['type']} call response status code: {resp2.status_code} ({ct:,.0f} seconds)")
 
-    # Start Time
-    st = time.time()
-    resp2 = post(data=data2, timeout=240)
-    # Call Time
-    ct = time.time() - st
+    else:
+        # Served from the cache; nothing to write back
+        key = None
 
-    if file_extension.replace(".", "").lower() == "pdf":
+    if extension == "pdf":
         # Just save and return the path
-        destination_handle = open(download_path, 'wb')
         with open(download_path, 'wb') as destination_handle:
-            destination_handle.write(resp2.content)
+            destination_handle.write(payload)
+
+        if key:
+            write_cached_download(cache_dir, key, extension, payload)
+
+        if job_key:
+            append_journal(journal_path, job=job_key, state="done")
 
         return download_path
 
     else:
         # This is a JSON response, then...
-        if clear_bad_escapes:
-            # Expensify uses colons as tag delimimters. If there's a colon in
-            #  the tag name, it "escapes" them with a backslash. That backslash,
-            #  which makes for invalid json because it's not actually escaping
-            #  anything, will blow up json.loads, so it needs to get gone.
-            # We don't turn \: into just :, though, because then a downstream
-            #  process can't tell if it's supposed to be a delimiter or a
-            #  literal colon. Instead, we make it something that a downstream
-            #  process is VERY unlikely to mistake for anything but a colon...
-            colon_cleansed_rj = re.sub(r"\\\\*:", "|||||", resp2.text)
-            # colon_cleansed_rj = resp2.text.replace("\\:", "|||||") #65403
-            rj = json.loads(colon_cleansed_rj)
+        rj = parse_export(payload, clear_bad_escapes=clear_bad_escapes,
+                          encoding=encoding, trace=trace)
 
-        else:
-            rj = resp2.json()
+    # Only cache what actually parsed (and isn't an error)
+    if key and not is_error_response(rj):
+        write_cached_download(cache_dir, key, extension,
+                              payload.decode(encoding).encode("utf-8"))
+
+    if job_key:
+        append_journal(journal_path, job=job_key, state="done")
 
     if verbosity > 2:
         if verbosity > 8:
             print(json.dumps(rj, indent=4))
 
-        print(f"Expensify {rjd2['type']} call response status code: {resp2.status_code} ({ct:,.0f} seconds)")
-
         if verbosity > 10:
-            print("Inspect resp2.text, rj:")
+            print("Inspect payload, rj:")
             import ipdb
             ipdb.set_trace()
 
     return rj
 
 
+def load_export_history(history_path=None):
+    """
+    The per-tenant export history, read from history_path if there is one
+     (and kept in EXPORT_HISTORY either way).
+    """
+    if history_path and os.path.exists(history_path):
+        with open(history_path) as history_handle:
+            EXPORT_HISTORY.update(json.load(history_handle))
+
+    return EXPORT_HISTORY
+
+
+def record_export(tenant, dimension, size, secs=None, history_path=None):
+    """
+    Notes how long an export of size days (or report IDs) took for a tenant,
+     or, if secs is None, that it was too large.
+    """
+    with EXPORT_HISTORY_LOCK:
+        stats = EXPORT_HISTORY.setdefault(tenant or "", {}).setdefault(
+            dimension, {"ok": [], "failed": []})
+
+        if secs is None:
+            stats["failed"] = (stats["failed"] + [size])[-EXPORT_HISTORY_LENGTH:]
+        else:
+            stats["ok"] = (stats["ok"] + [[size, secs]])[-EXPORT_HISTORY_LENGTH:]
+
+        if history_path:
+            temp_path = f"{history_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as history_handle:
+                json.dump(EXPORT_HISTORY, history_handle, indent=4)
+            os.replace(temp_path, history_path)
+
+
+def initial_split(tenant, dimension, size):
+    """
+    How many pieces to cut an export of size days (or report IDs) into
+     before trying it at all, judging by what's failed and how fast things
+     went for this tenant before.
+    """
+    stats = EXPORT_HISTORY.get(tenant or "", {}).get(dimension)
+
+    if not stats or size <= 1:
+        return 1
+
+    target = size
+
+    if stats["failed"]:
+        smallest_failure = min(stats["failed"])
+        successes_below = [ok_size for ok_size, _ in stats["ok"]
+                           if ok_size < smallest_failure]
+        target = max(successes_below) if successes_below else smallest_failure // 2
+
+    rates = sorted(secs / ok_size for ok_size, secs in stats["ok"] if ok_size)
+
+    if rates:
+        # Leave headroom under the timeout for the (median) observed speed
+        median_rate = rates[len(rates) // 2]
+        if median_rate > 0:
+            target = min(target, int(0.75 * EXPORT_TIMEOUT_SECS / median_rate))
+
+    # However fast or flaky things were, don't cut it into crumbs
+    target = max(target, -(-size // MAX_INITIAL_PIECES), 1)
+
+    return min(-(-size // target), size)
+
+
+def export_size(job_kwargs):
+    """
+    Which dimension an export can be split along, and how big it is in it.
+    """
+    report_ids = as_id_list(job_kwargs.get("report_ids"))
+
+    if report_ids:
+        return "reports", len(report_ids)
+
+    if job_kwargs.get("start_date"):
+        start = datetime.date.fromisoformat(str(job_kwargs["start_date"])[:10])
+        end = datetime.date.fromisoformat(
+            str(job_kwargs.get("end_date") or datetime.date.today())[:10])
+        return "days", max((end - start).days + 1, 1)
+
+    return None, 0
+
+
+def split_job(job_kwargs, pieces):
+    """
+    Cuts an export job into (up to) pieces consecutive date ranges or report
+     ID lists.
+    """
+    dimension, size = export_size(job_kwargs)
+    pieces = max(min(pieces, size), 1)
+    bounds = [size * i // pieces for i in range(pieces + 1)]
+    jobs = []
+
+    if dimension == "reports":
+        report_ids = as_id_list(job_kwargs["report_ids"])
+        for lo, hi in zip(bounds, bounds[1:]):
+            jobs.append(dict(job_kwargs, report_ids=report_ids[lo:hi]))
+
+    elif dimension == "days":
+        start = datetime.date.fromisoformat(str(job_kwargs["start_date"])[:10])
+        for lo, hi in zip(bounds, bounds[1:]):
+            jobs.append(dict(
+                job_kwargs,
+                start_date=str(start + datetime.timedelta(days=lo)),
+                end_date=str(start + datetime.timedelta(days=hi - 1))))
+
+    else:
+        jobs.append(job_kwargs)
+
+    return jobs
+
+
+def export_adaptively(job_kwargs, tenant=None, history_path=None, verbosity=0):
+    """
+    Runs an export job, bisecting it along its date range (or report ID list)
+     whenever it turns out to be too large, and recording how each piece
+     went in the tenant's history.
+    """
+    dimension, size = export_size(job_kwargs)
+    export_timing = {}
+
+    try:
+        rj = export_and_download_job(raise_if_too_large=True, export_timing=export_timing,
+                                     verbosity=verbosity, **job_kwargs)
+    except ExportTooLarge:
+        if size <= 1:
+            # Not a size problem after all, so it mustn't skew the history
+            raise
+
+        record_export(tenant, dimension, size, history_path=history_path)
+
+        if verbosity > 2:
+            print(f"Expensify export of {size:,} {dimension} too large; bisecting...")
+
+        rj = []
+        for half in split_job(job_kwargs, 2):
+            rj.extend(export_adaptively(half, tenant=tenant, history_path=history_path,
+                                        verbosity=verbosity))
+
+        return rj
+
+    # Only the export request itself says anything about how big a job can
+    #  be; pieces served from the cache didn't make one
+    if export_timing.get("secs") is not None:
+        record_export(tenant, dimension, size, export_timing["secs"], history_path=history_path)
+
+    if not isinstance(rj, list):
+        raise Exception(f"Can't combine split exports of type {type(rj).__name__}!")
+
+    return rj
+
+
+def chunked(ids, size):
+    """
+    ids, without duplicates (first one wins), in lists of at most size.
+    """
+    unique_ids = list(dict.fromkeys(ids))
+
+    return [unique_ids[i:i + size] for i in range(0, len(unique_ids), size)]
+
+
+def merge_exports(results, report_ids=None):
+    """
+    Concatenates the (list) results of several export jobs and, if
+     report_ids is given, puts rows in the order of their ReportID in it.
+     Every row is kept: the jobs cover distinct reports (or policies), and
+     identical-looking rows can be genuinely separate expenses.
+    """
+    rows = []
+
+    for rj in results:
+        if not isinstance(rj, list):
+            raise Exception(f"Can't combine split exports of type {type(rj).__name__}!")
+
+        rows.extend(rj)
+
+    if report_ids:
+        position = {report_id: i for i, report_id in enumerate(report_ids)}
+        # sort is stable, so rows keep Expensify's order within a report
+        rows.sort(key=lambda row: position.get(str(row.get("ReportID")), len(position))
+                  if isinstance(row, dict) else len(position))
+
+    return rows
+
+
+def export_unchunked(job_kwargs, adaptive=False, history_path=None, verbosity=0):
+    """
+    Runs an export job whose ID lists are short enough to send as they are,
+     either as is or, if adaptive, split up front and bisected as needed.
+    """
+    if not adaptive:
+        return export_and_download_job(verbosity=verbosity, **job_kwargs)
+
+    tenant = job_kwargs.get("partnerUserID")
+    load_export_history(history_path)
+
+    dimension, size = export_size(job_kwargs)
+    pieces = initial_split(tenant, dimension, size)
+
+    if verbosity > 2 and pieces > 1:
+        print(f"Expensify export of {size:,} {dimension} split into {pieces} pieces up front")
+
+    rj = []
+    for piece in split_job(job_kwargs, pieces):
+        rj.extend(export_adaptively(piece, tenant=tenant, history_path=history_path,
+                                    verbosity=verbosity))
+
+    return rj
+
+
+def export_chunks(chunk_kwargs, adaptive=False, history_path=None,
+                  max_workers=EXPORT_WORKERS, verbosity=0):
+    """
+    Runs export_unchunked for each of chunk_kwargs, max_workers at a time
+     (post() keeps them under the rate limit), returning their results in
+     the same order. If any fail, every chunk still runs to the end and
+     PartialExport carries the results of the ones that succeeded.
+    """
+    if len(chunk_kwargs) == 1:
+        return [export_unchunked(chunk_kwargs[0], adaptive=adaptive,
+                                 history_path=history_path, verbosity=verbosity)]
+
+    results = []
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(export_unchunked, kwargs, adaptive=adaptive,
+                                   history_path=history_path, verbosity=verbosity)
+                   for kwargs in chunk_kwargs]
+
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(e)
+
+    if errors:
+        raise PartialExport(results, errors)
+
+    return results
+
+
+@traced
+def export_and_download_reports(
+        report_states=None, limit=None, report_ids=None, policy_ids=None,
+        start_date=None, end_date=None, approved_after=None,
+        export_mark_filter=None, export_mark=None,
+        file_base_name="fo_exp_", file_extension="json", download_path=None,
+        template=None, clear_bad_escapes=True, cache_dir=None,
+        freeze_days=CACHE_FREEZE_DAYS, journal_path=None, adaptive=False,
+        history_path=None, max_workers=EXPORT_WORKERS, trace=None, verbosity=0,
+        **credentials):
+    """
+    https://integrations.expensify.com/Integration-Server/doc/#report-exporter
+
+    Exports and downloads the reports matching the filters (see
+     export_and_download_job).
+
+    If adaptive, an export that times out, or comes back with a 500 about
+     its size, is bisected along its date range (or report_ids list) and
+     its halves re-submitted, rather than retried as is. Each tenant's
+     history of export sizes and durations (kept in history_path, if given)
+     picks how many pieces to start with. Pieces are combined, so this only
+     applies to list-producing (e.g. json) exports without a limit. It
+     can't be combined with export_mark: a job that timed out may already
+     have marked its reports, and its halves would then skip them.
+
+    The same goes for more than MAX_REPORT_IDS_PER_JOB report_ids (or
+     MAX_POLICY_IDS_PER_JOB policy_ids): they're exported in chunks, up to
+     max_workers at a time, and the rows merged back in report_ids order
+     (duplicate report_ids are only exported once). Only one list is ever
+     chunked, so the number of jobs grows linearly with it: if both are
+     too long, each chunk of report_ids keeps the whole policy_ids filter
+     (chunking that too would run every report chunk once per policy
+     chunk, for no fewer rows). If some chunks fail,
+     PartialExport is raised after all of them have run; its results are
+     the merged rows of the chunks that succeeded, which may have marked
+     their reports already.
+    """
+    job_kwargs = dict(
+        report_states=report_states, limit=limit, report_ids=report_ids,
+        policy_ids=policy_ids, start_date=start_date, end_date=end_date,
+        approved_after=approved_after, export_mark_filter=export_mark_filter,
+        export_mark=export_mark, file_base_name=file_base_name,
+        file_extension=file_extension, download_path=download_path,
+        template=template, clear_bad_escapes=clear_bad_escapes,
+        cache_dir=cache_dir, freeze_days=freeze_days, journal_path=journal_path,
+        trace=trace, **credentials)
+
+    splittable = not limit and file_extension.replace(".", "").lower() != "pdf"
+
+    if adaptive and export_mark:
+        raise Exception("adaptive exports can't mark reports as exported (export_mark)!")
+
+    report_ids = as_id_list(report_ids)
+    policy_ids = as_id_list(policy_ids)
+
+    if splittable and (len(report_ids) > MAX_REPORT_IDS_PER_JOB
+                       or len(policy_ids) > MAX_POLICY_IDS_PER_JOB):
+        if len(report_ids) > MAX_REPORT_IDS_PER_JOB:
+            chunks = [{"report_ids": chunk} for chunk in chunked(report_ids, MAX_REPORT_IDS_PER_JOB)]
+        else:
+            # Reports belong to a single policy, so these can't overlap
+            chunks = [{"policy_ids": chunk} for chunk in chunked(policy_ids, MAX_POLICY_IDS_PER_JOB)]
+
+        if verbosity > 2:
+            print(f"Expensify export split into {len(chunks)} chunks ({max_workers} at a time)")
+
+        try:
+            results = export_chunks([dict(job_kwargs, **chunk) for chunk in chunks],
+                                    adaptive=adaptive and splittable, history_path=history_path,
+                                    max_workers=max_workers, verbosity=verbosity)
+        except PartialExport as e:
+            e.results = merge_exports(e.results, report_ids=list(dict.fromkeys(report_ids)))
+            raise
+
+        return merge_exports(results, report_ids=list(dict.fromkeys(report_ids)))
+
+    return export_unchunked(job_kwargs, adaptive=adaptive and splittable,
+                            history_path=history_path, verbosity=verbosity)
+
+
 # @retry()
+@traced
 def export_and_download_reconciliation(
         domain, start_date, end_date,
         reconciliation_type="Unreported", asynchronous=False,
         file_base_name="fo_exp_", file_extension="json",
         download_path=None, template=None, clear_bad_escapes=True,
-        verbosity=0, **credentials):
+        trace=None, verbosity=0, **credentials):
     """
     https://integrations.expensify.com/Integration-Server/doc/#report-exporter
 
@@ -307,7 +1300,7 @@ def export_and_download_reconciliation(
 
     # Start Time
     st = time.time()
-    resp = post(data=data, timeout=240)
+    resp = post(data=data, timeout=240, trace=trace)
     # Call Time
     ct = time.time() - st
 
@@ -343,7 +1336,7 @@ def export_and_download_reconciliation(
 
     # Start Time
     st = time.time()
-    resp2 = post(data=data2, timeout=240)
+    resp2 = post(data=data2, timeout=240, trace=trace)
 
     if verbosity > 8:
         print(resp2)
@@ -361,7 +1354,8 @@ def export_and_download_reconciliation(
         return download_path
 
     else:
-        rj = resp2.json()
+        with trace_span(trace, "parse", len(resp2.content)):
+            rj = resp2.json()
 
     if verbosity > 2:
         if verbosity > 6:
@@ -379,8 +1373,10 @@ def export_and_download_reconciliation(
     return rj
 
 
+@traced
 @retry()
-def get_policies(policy_ids=None, user_email=None, verbosity=0, **credentials):
+def get_policies(policy_ids=None, user_email=None, trace=None, verbosity=0,
+                 **credentials):
     """
     https://integrations.expensify.com/Integration-Server/doc/#policy-getter
     """
@@ -418,8 +1414,10 @@ def get_policies(policy_ids=None, user_email=None, verbosity=0, **credentials):
 
     # Start Time
     st = time.time()
-    resp = post(data=data, timeout=240)
-    rj = resp.json()
+    resp = post(data=data, timeout=240, trace=trace)
+
+    with trace_span(trace, "parse", len(resp.content)):
+        rj = resp.json()
     # Call Time
     ct = time.time() - st
 
@@ -436,8 +1434,334 @@ def get_policies(policy_ids=None, user_email=None, verbosity=0, **credentials):
     return resp.json()
 
 
+def tag_parent(tag):
+    """
+    The parent a (get_policies) tag names under any parent-ish key, or None.
+    """
+    for key, value in tag.items():
+        if PARENT_TAG_KEY_PATTERN.search(key) and isinstance(value, str) and value:
+            return value
+
+    return None
+
+
+def has_dependent_tags(levels):
+    """
+    Do these tag levels (from get_policies) depend on each other, e.g. a
+     level 2 tag only being valid under certain level 1 tags?
+    """
+    for depth, level in enumerate(levels):
+        if any(DEPENDENT_LEVEL_KEY_PATTERN.search(key) and value for key, value in level.items()):
+            return True
+
+        for tag in level.get("tags") or []:
+            if tag_parent(tag) or (depth and len(tag_segments(tag["name"])) > 1):
+                return True
+
+    return False
+
+
+def unescape_tag(name):
+    """
+    Tag names with literal colons, however they were escaped.
+    """
+    return str(name).replace(ESCAPED_COLON, ":").replace("\\:", ":").strip()
+
+
+def tag_segments(tag):
+    """
+    Splits an exported tag on its (unescaped) colon delimiters, e.g.
+     "East:Sales|||||Ops" -> ["East", "Sales:Ops"]. Trailing blank levels
+     ("East:") are dropped.
+    """
+    segments = [unescape_tag(segment) for segment in re.split(r"(?<!\\):", str(tag))]
+
+    while segments and not segments[-1]:
+        segments.pop()
+
+    return segments
+
+
+class TagTrie:
+    """
+    A prefix tree of multi-level tags: each node's children are the next
+     level's tags, keyed by name. When the levels are independent (as
+     Expensify's are unless they were imported as dependent), all the tags
+     of a level share one dict of children rather than copying it; when
+     they're dependent, each tag gets just the children listed under it.
+    """
+    def __init__(self, tag=None, children=None):
+        self.tag = tag
+        self.children = {} if children is None else children
+
+    @classmethod
+    def from_levels(cls, levels):
+        """
+        Builds the trie from the "tags" of a get_policies policy.
+        """
+        root = cls()
+
+        for level in reversed(levels):
+            below = root.children
+            root = cls()
+
+            for tag in level.get("tags") or []:
+                root.children[unescape_tag(tag["name"])] = cls(tag, below)
+
+        return root
+
+    @classmethod
+    def from_dependent_levels(cls, levels):
+        """
+        Builds the trie from the "tags" of a get_policies policy whose levels
+         depend on each other. Tags below the first level must say which
+         parent they belong under, by a full-path name or a parent key (its
+         full path, or just its name if that's unique in its level), or
+         DependentTagsUnresolved is raised.
+        """
+        root = cls()
+        # The previous level's nodes, by name
+        parents = {}
+
+        for depth, level in enumerate(levels):
+            nodes = {}
+
+            for tag in level.get("tags") or []:
+                segments = tag_segments(tag["name"])
+                parent_path = tag_segments(tag_parent(tag) or "")
+                parent = None
+
+                if depth == 0:
+                    parent, name = root, unescape_tag(tag["name"])
+                elif len(segments) == depth + 1:
+                    parent, name = root.find(segments[:-1]), segments[-1]
+                elif len(parent_path) == depth:
+                    parent, name = root.find(parent_path), unescape_tag(tag["name"])
+                elif len(parent_path) == 1 and len(parents.get(parent_path[0], [])) == 1:
+                    parent, name = parents[parent_path[0]][0], unescape_tag(tag["name"])
+
+                if parent is None:
+                    raise DependentTagsUnresolved(
+                        f"Can't tell which level {depth} tag {tag['name']!r} belongs under!")
+
+                node = cls(tag)
+                parent.children[name] = node
+                nodes.setdefault(name, []).append(node)
+
+            parents = nodes
+
+        return root
+
+    def find(self, segments):
+        """
+        The node segments spell, or None.
+        """
+        node = self
+
+        for segment in segments:
+            node = node.children.get(segment)
+
+            if node is None:
+                return None
+
+        return node
+
+    def walk(self, segments):
+        """
+        The tag (dict) at each level segments spells, or None if they don't.
+        """
+        node = self
+        tags = []
+
+        for segment in segments:
+            node = node.children.get(segment)
+
+            if node is None:
+                return None
+
+            tags.append(node.tag)
+
+        return tags
+
+
+class PolicyIndex:
+    """
+    get_policies output compiled for fast lookups: categories, tax rates and
+     report fields by name, and a TagTrie of each policy's tags. Looking up
+     the tags of a policy whose dependent tags couldn't be put in a trie
+     raises DependentTagsUnresolved.
+    """
+    def __init__(self, policy_info=None):
+        self.policies = {}
+
+        if policy_info:
+            self.add(policy_info)
+
+    def add(self, policy_info):
+        """
+        Indexes the "policyInfo" of a get_policies response.
+        """
+        for policy_id, policy in policy_info.items():
+            categories = {unescape_tag(category["name"]): category
+                          for category in policy.get("categories") or []}
+
+            levels = policy.get("tags") or []
+            tags_error = None
+
+            try:
+                tags = (TagTrie.from_dependent_levels(levels) if has_dependent_tags(levels)
+                        else TagTrie.from_levels(levels))
+            except DependentTagsUnresolved as e:
+                tags, tags_error = None, str(e)
+
+            report_fields = {}
+            for field in policy.get("reportFields") or []:
+                report_fields[field["name"]] = dict(field, values=set(field.get("values") or []))
+
+            tax = policy.get("tax") or {}
+            rates = (tax.get("rates") or []) if isinstance(tax, dict) else tax
+            tax_rates = {}
+            for rate in rates:
+                for rate_key in ("rateID", "name"):
+                    if rate.get(rate_key) is not None:
+                        tax_rates[rate[rate_key]] = rate
+
+            self.policies[policy_id] = {
+                "categories": categories,
+                "tags": tags,
+                "tags_error": tags_error,
+                "report_fields": report_fields,
+                "tax_rates": tax_rates,
+                "default_tax": tax.get("default") if isinstance(tax, dict) else None,
+            }
+
+        return self
+
+    def category(self, policy_id, name):
+        return self.policies[policy_id]["categories"].get(unescape_tag(name))
+
+    def tax_rate(self, policy_id, rate):
+        """
+        A tax rate by its ID or name (the policy's default if rate is None).
+        """
+        policy = self.policies[policy_id]
+        return policy["tax_rates"].get(policy["default_tax"] if rate is None else rate)
+
+    def report_field_allows(self, policy_id, field_name, value):
+        field = self.policies[policy_id]["report_fields"].get(field_name)
+        # Fields without a list of values (e.g. text fields) take anything
+        return field is not None and (not field["values"] or value in field["values"])
+
+    def tags(self, policy_id, tag):
+        """
+        The policy's tag (dict) for each level of an exported tag, or None if
+         it doesn't spell a valid combination.
+        """
+        policy = self.policies[policy_id]
+
+        if policy["tags"] is None:
+            raise DependentTagsUnresolved(policy["tags_error"])
+
+        return policy["tags"].walk(tag_segments(tag))
+
+
+def build_policy_index(policy_ids, batch_size=POLICY_IDS_PER_REQUEST,
+                       max_workers=EXPORT_WORKERS, user_email=None,
+                       trace=None, verbosity=0, **credentials):
+    """
+    Fetches policy_ids in batches of batch_size (up to max_workers at a
+     time) and compiles them into a PolicyIndex.
+    """
+    batches = chunked(as_id_list(policy_ids), batch_size)
+    index = PolicyIndex()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(get_policies, policy_ids=batch, user_email=user_email,
+                                   trace=trace, verbosity=verbosity, **credentials)
+                   for batch in batches]
+
+        for future in futures:
+            index.add(future.result()["policyInfo"])
+
+    if verbosity > 2:
+        print(f"Expensify policy index built for {len(index.policies):,} policies "
+              f"({len(batches)} requests)")
+
+    return index
+
+
+def validate_expenses(expenses, index, policy_id=None, policy_field="PolicyID",
+                      category_field="Category", tag_field="Tag",
+                      tax_field=None, report_fields=()):
+    """
+    Checks exported expenses (dicts) against a PolicyIndex in one pass,
+     yielding (position, field, value, problem) for each problem found.
+     Each expense's policy comes from its policy_field, else policy_id.
+     Blank categories and tags aren't problems. List values (e.g. of
+     multi-value report fields) are checked item by item; dict values are
+     skipped. Results are memoized per policy and value, since millions of
+     expenses share a few thousand. Tags of policies whose dependent tags
+     couldn't be indexed are reported as unvalidatable rather than guessed
+     at.
+    """
+    verdicts = {}
+
+    def verdict(policy, field, value):
+        memo_key = (policy, field, value)
+
+        if memo_key not in verdicts:
+            if field == category_field:
+                category = index.category(policy, value)
+                verdicts[memo_key] = ("unknown category" if category is None
+                                      else None if category.get("enabled", True)
+                                      else "disabled category")
+            elif field == tag_field:
+                try:
+                    tags = index.tags(policy, value)
+                except DependentTagsUnresolved:
+                    verdicts[memo_key] = "dependent tags can't be validated"
+                else:
+                    verdicts[memo_key] = ("unknown tag" if tags is None
+                                          else None if all(tag.get("enabled", True) for tag in tags)
+                                          else "disabled tag")
+            elif field == tax_field:
+                verdicts[memo_key] = None if index.tax_rate(policy, value) else "unknown tax rate"
+            else:
+                verdicts[memo_key] = (None if index.report_field_allows(policy, field, value)
+                                      else "invalid report field value")
+
+        return verdicts[memo_key]
+
+    fields = [field for field in (category_field, tag_field, tax_field) if field]
+    fields.extend(report_fields)
+
+    for position, expense in enumerate(expenses):
+        policy = expense.get(policy_field) or policy_id
+
+        if policy not in index.policies:
+            yield position, policy_field, policy, "unknown policy"
+            continue
+
+        for field in fields:
+            value = expense.get(field)
+
+            if value in (None, ""):
+                continue
+
+            for item in value if isinstance(value, (list, tuple)) else [value]:
+                if isinstance(item, (dict, list, set)):
+                    # Not hashable, so not memoizable or comparable to names
+                    continue
+
+                problem = verdict(policy, field, item)
+
+                if problem:
+                    yield position, field, item, problem
+
+
+@traced
 @retry()
-def get_policy_list(admin_only=True, user_email=None, verbosity=0,
+def get_policy_list(admin_only=True, user_email=None, trace=None, verbosity=0,
                     **credentials):
     """
     https://integrations.expensify.com/Integration-Server/doc/
@@ -471,7 +1795,7 @@ def get_policy_list(admin_only=True, user_email=None, verbosity=0,
 
     # Start Time
     st = time.time()
-    resp = post(data=data, timeout=60)
+    resp = post(data=data, timeout=60, trace=trace)
     # Call Time
     ct = time.time() - st
 
@@ -493,8 +1817,10 @@ def get_policy_list(admin_only=True, user_email=None, verbosity=0,
     return resp.json()
 
 
+@traced
 @retry()
-def update_employees(policy_id, data_path, verbosity=0, **credentials):
+def update_employees(policy_id, data_path, trace=None, verbosity=0,
+                     **credentials):
     """
     https://integrations.expensify.com/Integration-Server/doc/#employee-updater
     """
@@ -519,7 +1845,7 @@ def update_employees(policy_id, data_path, verbosity=0, **credentials):
 
     # Start Time
     st = time.time()
-    resp = post(data=data, files=files, timeout=60)
+    resp = post(data=data, files=files, timeout=60, trace=trace)
     # Call Time
     ct = time.time() - st
 
@@ -533,9 +1859,11 @@ def update_employees(policy_id, data_path, verbosity=0, **credentials):
     return resp.json()
 
 
+@traced
 @retry()
 def update_policy(policy_id, categories=None, tags=None,
-                  default_action="replace", verbosity=0, **credentials):
+                  default_action="replace", trace=None, verbosity=0,
+                  **credentials):
     """
     https://integrations.expensify.com/Integration-Server/doc/#policy-updater
 
@@ -578,7 +1906,7 @@ def update_policy(policy_id, categories=None, tags=None,
 
     # Start Time
     st = time.time()
-    resp = post(data=data, timeout=60)
+    resp = post(data=data, timeout=60, trace=trace)
     # Call Time
     ct = time.time() - st
 
@@ -607,8 +1935,9 @@ def update_policy(policy_id, categories=None, tags=None,
     return resp.json()
 
 
+@traced
 @retry()
-def set_report_status(report_ids, status="REIMBURSED", verbosity=0,
+def set_report_status(report_ids, status="REIMBURSED", trace=None, verbosity=0,
                       **credentials):
     """
     Currently REIMBURSED is the only thing you can set a report's status to:
@@ -635,7 +1964,7 @@ def set_report_status(report_ids, status="REIMBURSED", verbosity=0,
 
     # Start Time
     st = time.time()
-    resp = post(data=data, timeout=60)
+    resp = post(data=data, timeout=60, trace=trace)
     # Call Time
     ct = time.time() - st
 
@@ -653,3 +1982,213 @@ def set_report_status(report_ids, status="REIMBURSED", verbosity=0,
               f"code: {resp.status_code} ({ct:,.0f} seconds)")
 
     return rj
+
+
+def import_pyarrow():
+    """
+    pyarrow is only needed for export archives, so it's imported on demand.
+    """
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.feather
+        import pyarrow.fs
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Export archives need pyarrow (pip install pyarrow)") from e
+
+    return pyarrow
+
+
+def archive_policy(policy):
+    """
+    A policy ID as it appears in an archive's directory names.
+    """
+    return re.sub(r"[^\w.-]", "_", str(policy))
+
+
+def archive_month(value):
+    """
+    The month (yyyy-mm) of a date, datetime or date string (in any of
+     ARCHIVE_DATE_FORMATS, with or without a time), or "unknown".
+    """
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return f"{value:%Y-%m}"
+
+    date_part = re.split(r"[T ]", str(value or "").strip())[0]
+
+    for date_format in ARCHIVE_DATE_FORMATS:
+        try:
+            return f"{datetime.datetime.strptime(date_part, date_format):%Y-%m}"
+        except ValueError:
+            continue
+
+    return "unknown"
+
+
+def archive_partitioning(pa):
+    # Explicitly strings, or numeric-looking policy IDs would come back as ints
+    return pa.dataset.partitioning(
+        pa.schema([(field, pa.string()) for field in ARCHIVE_PARTITION_FIELDS]), flavor="hive")
+
+
+def read_archive_schema(pa, root):
+    path = os.path.join(root, ARCHIVE_SCHEMA_FILE)
+
+    if not os.path.exists(path):
+        return None
+
+    with pa.ipc.open_file(path) as schema_reader:
+        return schema_reader.schema
+
+
+def update_archive_schema(pa, root, rows):
+    """
+    The archive's schema, widened to fit rows (e.g. a column that was all
+     null so far now has strings, or ints now have floats) and saved.
+     Incompatible types (say, string IDs where they were ints), and columns
+     named like the partitions, raise.
+    """
+    archived = read_archive_schema(pa, root)
+    inferred = pa.Table.from_pylist(rows).schema
+    clashing = [name for name in inferred.names if name in ARCHIVE_PARTITION_FIELDS]
+
+    if clashing:
+        raise Exception(f"Rows can't have {', '.join(clashing)} columns; the archive under {root} "
+                        f"is partitioned by them. Rename them in the export template!")
+
+    if archived is None:
+        schema = inferred
+    else:
+        try:
+            schema = pa.unify_schemas([archived, inferred], promote_options="permissive")
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise Exception(f"These rows don't fit the archive under {root}: {e}") from e
+
+        if schema.equals(archived):
+            return schema
+
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, ARCHIVE_SCHEMA_FILE)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    pa.ipc.new_file(temp_path, schema).close()
+    os.replace(temp_path, path)
+
+    return schema
+
+
+def archive_exports(rows, root, date_field, policy_field=None, policy_id=None,
+                    file_format="parquet", verbosity=0):
+    """
+    Appends export rows (e.g. from export_and_download_reports) to an
+     archive under root, partitioned by policy (each row's policy_field,
+     else policy_id) and month (of its date_field, see archive_month).
+     DEFAULT_JSON_TEMPLATE has neither, so use a template that exports them
+     (or pass policy_id when archiving one policy's rows). Every call adds
+     a new part file to each partition it touches, so incremental runs
+     never rewrite earlier ones. Returns the paths written.
+
+    All part files share the archive's schema (see update_archive_schema),
+     so later scans don't trip over types inferred from one batch. Rows
+     can't have policy or month columns of their own.
+
+    feather files are written uncompressed so that reads can memory-map
+     them without copying; parquet ones are smaller.
+    """
+    if file_format not in ARCHIVE_FORMATS:
+        raise NotImplementedError(file_format)
+
+    if not policy_field and not policy_id:
+        raise Exception("Need either a policy_field or a policy_id to partition by!")
+
+    rows = list(rows)
+
+    if not rows:
+        return []
+
+    pa = import_pyarrow()
+    schema = update_archive_schema(pa, root, rows)
+    partitions = {}
+
+    for row in rows:
+        policy = (row.get(policy_field) if policy_field else None) or policy_id or "unknown"
+        month = archive_month(row.get(date_field))
+        partitions.setdefault((str(policy), month), []).append(row)
+
+    paths = []
+    batch_name = f"part-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.{file_format}"
+
+    for (policy, month), partition_rows in partitions.items():
+        directory = os.path.join(root, f"policy={archive_policy(policy)}", f"month={month}")
+        os.makedirs(directory, exist_ok=True)
+
+        path = os.path.join(directory, batch_name)
+        # Dot files are invisible to readers until they're complete
+        temp_path = os.path.join(directory, f".{batch_name}.tmp")
+        table = pa.Table.from_pylist(partition_rows, schema=schema)
+
+        if file_format == "feather":
+            pa.feather.write_feather(table, temp_path, compression="uncompressed")
+        else:
+            pa.parquet.write_table(table, temp_path)
+
+        os.replace(temp_path, path)
+        paths.append(path)
+
+    if verbosity > 2:
+        print(f"Archived {sum(len(partition) for partition in partitions.values()):,} rows "
+              f"in {len(paths)} {file_format} files under {root}")
+
+    return paths
+
+
+def open_export_archive(root, file_format="parquet"):
+    """
+    The archive under root as a memory-mapped pyarrow.dataset.Dataset, with
+     policy and month partition columns. Scan it in batches, or use
+     read_export_archive for a Table.
+    """
+    if file_format not in ARCHIVE_FORMATS:
+        raise NotImplementedError(file_format)
+
+    pa = import_pyarrow()
+    partitioning = archive_partitioning(pa)
+    schema = read_archive_schema(pa, root)
+
+    if schema is not None:
+        # Older part files are cast up to the archive's (widened) schema
+        for field in partitioning.schema:
+            schema = schema.append(field)
+
+    return pa.dataset.dataset(
+        root, schema=schema, format=ARCHIVE_FORMATS[file_format],
+        filesystem=pa.fs.LocalFileSystem(use_mmap=True),
+        partitioning=partitioning)
+
+
+def read_export_archive(root, columns=None, policies=None, months=None,
+                        filter=None, file_format="parquet"):
+    """
+    Reads just the columns asked for, from just the partitions (policies,
+     months) and row groups that can match, into a pyarrow.Table. filter is
+     any other pyarrow.dataset expression, e.g.
+     pyarrow.dataset.field("Amount") > 10000, and is pushed down to the
+     files too.
+    """
+    pa = import_pyarrow()
+    dataset = open_export_archive(root, file_format=file_format)
+
+    if isinstance(policies, str):
+        policies = policies.split(",")
+
+    if isinstance(months, str):
+        months = months.split(",")
+
+    for partition, values in (("policy", [archive_policy(policy) for policy in policies or []]),
+                              ("month", [str(month) for month in months or []])):
+        if values:
+            expression = pa.dataset.field(partition).isin(values)
+            filter = expression if filter is None else filter & expression
+
+    return dataset.to_table(columns=columns, filter=filter)
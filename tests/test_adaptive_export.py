@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+"""
+Adaptive (split-on-timeout) exports, with post() faked so nothing reaches
+ Expensify.
+"""
+import datetime
+import json
+import tempfile
+import unittest
+
+from unittest import mock
+
+import requests
+
+import fo_expensify.fo_expensify as fo_expensify
+
+
+class FakeResponse:
+    def __init__(self, text, status_code=200, secs=0.0):
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.status_code = status_code
+        self.encoding = "utf-8"
+        self.elapsed = datetime.timedelta(seconds=secs)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeExpensify:
+    """
+    Stands in for post(): exports of more than max_days days fail with
+     too_large (an exception to raise or a response to return), others take
+     a second per day. Downloads get a row per day of the export.
+    """
+    def __init__(self, max_days=8, too_large=None):
+        self.max_days = max_days
+        self.too_large = too_large or requests.exceptions.ReadTimeout()
+        self.exports = []
+
+    def __call__(self, data, files=None, timeout=60, trace=None):
+        rjd = json.loads(data["requestJobDescription"])
+
+        if rjd["type"] == "file":
+            filters = rjd["inputSettings"]["filters"]
+            start = datetime.date.fromisoformat(filters["startDate"])
+            end = datetime.date.fromisoformat(filters["endDate"])
+            days = (end - start).days + 1
+            self.exports.append(days)
+
+            if days > self.max_days:
+                if isinstance(self.too_large, Exception):
+                    raise self.too_large
+                return self.too_large
+
+            return FakeResponse(f"{start}_{end}.json", secs=days)
+
+        start, end = (datetime.date.fromisoformat(part)
+                      for part in rjd["fileName"][:-len(".json")].split("_"))
+        rows = [{"ReportID": str(start + datetime.timedelta(days=day))}
+                for day in range((end - start).days + 1)]
+        return FakeResponse(json.dumps(rows))
+
+
+class AdaptiveExportTest(unittest.TestCase):
+    def setUp(self):
+        self.kwargs = dict(start_date="2024-01-01", end_date="2024-01-31", adaptive=True,
+                           partnerUserID="user", partnerUserSecret="secret")
+        for patcher in (mock.patch("time.sleep"),
+                        mock.patch.dict(fo_expensify.EXPORT_HISTORY, clear=True)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def history(self):
+        return fo_expensify.EXPORT_HISTORY["user"]["days"]
+
+    def test_oversized_export_is_bisected(self):
+        expensify = FakeExpensify(max_days=8)
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            rj = fo_expensify.export_and_download_reports(**self.kwargs)
+
+        self.assertEqual([row["ReportID"] for row in rj],
+                         [f"2024-01-{day:02}" for day in range(1, 32)])
+        self.assertEqual(expensify.exports, [31, 15, 7, 8, 16, 8, 8])
+        self.assertEqual(self.history()["failed"], [31, 15, 16])
+        # Timed by the export request alone, a second per day
+        self.assertEqual(self.history()["ok"], [[7, 7.0], [8, 8.0], [8, 8.0], [8, 8.0]])
+
+    def test_history_picks_the_initial_split(self):
+        expensify = FakeExpensify(max_days=8)
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            fo_expensify.export_and_download_reports(**self.kwargs)
+            expensify.exports = []
+            fo_expensify.export_and_download_reports(**self.kwargs)
+
+        self.assertEqual(expensify.exports, [7, 8, 8, 8])
+
+    def test_size_errors_are_bisected(self):
+        too_large = FakeResponse('{"responseCode": 500, "responseMessage": "Export size limit exceeded"}')
+        expensify = FakeExpensify(max_days=16, too_large=too_large)
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            rj = fo_expensify.export_and_download_reports(**self.kwargs)
+
+        self.assertEqual(len(rj), 31)
+        self.assertEqual(expensify.exports, [31, 15, 16])
+
+    def test_other_failures_are_retried_not_bisected(self):
+        rate_limited = FakeResponse('{"responseCode": 500, "responseMessage": "Rate limit exceeded"}')
+
+        for too_large in (requests.exceptions.ConnectTimeout(), rate_limited):
+            expensify = FakeExpensify(max_days=8, too_large=too_large)
+
+            with mock.patch.object(fo_expensify, "post", expensify):
+                with self.assertRaises(Exception):
+                    fo_expensify.export_and_download_reports(**self.kwargs)
+
+            self.assertEqual(expensify.exports, [31] * fo_expensify.MAX_TRIES)
+            self.assertEqual(fo_expensify.EXPORT_HISTORY, {})
+
+    def test_cached_pieces_are_not_recorded(self):
+        expensify = FakeExpensify(max_days=31)
+        kwargs = dict(self.kwargs, cache_dir=tempfile.mkdtemp())
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            fo_expensify.export_and_download_reports(**kwargs)
+            fo_expensify.export_and_download_reports(**kwargs)
+
+        self.assertEqual(expensify.exports, [31])
+        self.assertEqual(self.history()["ok"], [[31, 31.0]])
+
+    def test_size_error_pattern(self):
+        for message in ("File too large", "Maximum file size exceeded", "Export size limit exceeded",
+                        "Request timed out", "Response exceeds the maximum allowed"):
+            self.assertTrue(fo_expensify.SIZE_ERROR_PATTERN.search(message), message)
+
+        for message in ("Rate limit exceeded", "Limit exceeded", "Invalid size parameter",
+                        "Authentication error"):
+            self.assertFalse(fo_expensify.SIZE_ERROR_PATTERN.search(message), message)
+
+
+class InitialSplitTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(fo_expensify.EXPORT_HISTORY, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_no_history_means_one_piece(self):
+        self.assertEqual(fo_expensify.initial_split("user", "days", 365), 1)
+
+    def test_largest_success_below_the_smallest_failure(self):
+        fo_expensify.EXPORT_HISTORY["user"] = {"days": {"ok": [[7, 7], [8, 8], [20, 20]], "failed": [15]}}
+
+        self.assertEqual(fo_expensify.initial_split("user", "days", 31), 4)
+        # Other tenants and dimensions are unaffected
+        self.assertEqual(fo_expensify.initial_split("other", "days", 31), 1)
+        self.assertEqual(fo_expensify.initial_split("user", "reports", 31), 1)
+
+    def test_slow_tenants_leave_headroom_under_the_timeout(self):
+        # 0.75 * 240 secs at 18 secs per day is 10 days a piece
+        fo_expensify.EXPORT_HISTORY["user"] = {"days": {"ok": [[10, 180], [5, 90]], "failed": []}}
+
+        self.assertEqual(fo_expensify.initial_split("user", "days", 100), 10)
+
+    def test_never_more_than_max_initial_pieces(self):
+        fo_expensify.EXPORT_HISTORY["user"] = {"days": {"ok": [], "failed": [2]}}
+
+        self.assertLessEqual(fo_expensify.initial_split("user", "days", 3650),
+                             fo_expensify.MAX_INITIAL_PIECES)
+
+
+class SplitJobTest(unittest.TestCase):
+    def test_days_are_split_into_consecutive_ranges(self):
+        jobs = fo_expensify.split_job({"start_date": "2024-01-01", "end_date": "2024-01-31"}, 4)
+
+        self.assertEqual([(job["start_date"], job["end_date"]) for job in jobs],
+                         [("2024-01-01", "2024-01-07"), ("2024-01-08", "2024-01-15"),
+                          ("2024-01-16", "2024-01-23"), ("2024-01-24", "2024-01-31")])
+
+    def test_report_ids_are_split_in_order(self):
+        jobs = fo_expensify.split_job({"report_ids": "1,2,3,4,5"}, 2)
+
+        self.assertEqual([job["report_ids"] for job in jobs], [["1", "2"], ["3", "4", "5"]])
+
+    def test_never_more_pieces_than_items(self):
+        jobs = fo_expensify.split_job({"start_date": "2024-01-01", "end_date": "2024-01-02"}, 8)
+
+        self.assertEqual(len(jobs), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Call traces: spans recorded by post() and the job functions, and profiling,
+ with requests.post faked so nothing reaches Expensify.
+"""
+import json
+import threading
+import tracemalloc
+import unittest
+
+from unittest import mock
+
+import requests
+
+from urllib3.exceptions import ReadTimeoutError
+
+import fo_expensify.fo_expensify as fo_expensify
+
+
+class FakeRequest:
+    method = "POST"
+
+
+class FakeResponse:
+    """
+    A (streamed) requests response whose body is text, or whose reading
+     raises body_error.
+    """
+    def __init__(self, text="", body_error=None):
+        self.text = text
+        self.body_error = body_error
+        self.status_code = 200
+        self.reason = "OK"
+        self.encoding = "utf-8"
+        self.request = FakeRequest()
+        self.url = fo_expensify.URL
+
+    @property
+    def content(self):
+        if self.body_error:
+            raise self.body_error
+        return self.text.encode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def fake_requests_post(url, data, files=None, timeout=None, stream=False):
+    rjd = json.loads(data["requestJobDescription"])
+
+    if rjd["type"] == "file":
+        return FakeResponse("exportfile.json")
+
+    return FakeResponse('[{"ReportID": "1", "Tag": "East\\\\:Coast"}]')
+
+
+class CallTraceTest(unittest.TestCase):
+    def setUp(self):
+        for patcher in (mock.patch.object(fo_expensify, "informed_sleep"),
+                        mock.patch("time.sleep")):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_every_phase_is_recorded(self):
+        trace = fo_expensify.CallTrace()
+
+        with mock.patch.object(fo_expensify.requests, "post", fake_requests_post):
+            rj = fo_expensify.export_and_download_reports(
+                start_date="2024-01-01", trace=trace, partnerUserID="user", partnerUserSecret="secret")
+
+        self.assertEqual(rj, [{"ReportID": "1", "Tag": "East|||||Coast"}])
+        self.assertEqual([span["phase"] for span in trace.spans],
+                         ["build job", "throttle", "server wait", "download",
+                          "throttle", "server wait", "download", "cleanse", "parse"])
+
+        totals = trace.totals()
+        self.assertEqual(totals["throttle"]["count"], 2)
+        self.assertEqual(totals["download"]["bytes"],
+                         len("exportfile.json") + len('[{"ReportID": "1", "Tag": "East\\\\:Coast"}]'))
+        self.assertIn("server wait", str(trace))
+
+    def test_streamed_read_timeouts_stay_timeouts(self):
+        read_timeout = requests.exceptions.ConnectionError(ReadTimeoutError(None, None, "Read timed out."))
+        response = FakeResponse(body_error=read_timeout)
+
+        with mock.patch.object(fo_expensify.requests, "post", return_value=response):
+            with self.assertRaises(requests.exceptions.ReadTimeout):
+                fo_expensify.post({"requestJobDescription": "{}"}, trace=fo_expensify.CallTrace())
+
+    def test_other_streamed_connection_errors_are_left_alone(self):
+        response = FakeResponse(body_error=requests.exceptions.ConnectionError("Connection reset"))
+
+        with mock.patch.object(fo_expensify.requests, "post", return_value=response):
+            with self.assertRaises(requests.exceptions.ConnectionError) as raised:
+                fo_expensify.post({"requestJobDescription": "{}"}, trace=fo_expensify.CallTrace())
+
+        self.assertNotIsInstance(raised.exception, requests.exceptions.Timeout)
+
+    def test_profiling(self):
+        trace = fo_expensify.CallTrace(profile=True)
+
+        @fo_expensify.traced
+        def work(trace=None):
+            return [bytearray(1024 * 1024)]
+
+        work(trace=trace)
+
+        self.assertIsNotNone(trace.stats)
+        self.assertGreaterEqual(trace.peak_memory, 1024 * 1024)
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_concurrent_profiled_calls(self):
+        both_running = threading.Barrier(2, timeout=10)
+        traces = [fo_expensify.CallTrace(profile=True) for _ in range(2)]
+        errors = []
+
+        @fo_expensify.traced
+        def work(trace=None):
+            both_running.wait()
+
+        def run(trace):
+            try:
+                work(trace=trace)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(trace,)) for trace in traces]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        # Only one of them gets cProfile stats, but both get a memory peak
+        self.assertEqual(sum(trace.stats is not None for trace in traces), 1)
+        self.assertTrue(all(trace.peak_memory is not None for trace in traces))
+        self.assertFalse(tracemalloc.is_tracing())
+
+        # ...and the profiler is free again afterwards
+        work_trace = fo_expensify.CallTrace(profile=True)
+        both_running = threading.Barrier(1)
+        work(trace=work_trace)
+        self.assertIsNotNone(work_trace.stats)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+Chunked exports of long report and policy ID lists, with post() faked so
+ nothing reaches Expensify.
+"""
+import json
+import threading
+import unittest
+
+from unittest import mock
+
+import fo_expensify.fo_expensify as fo_expensify
+
+
+class FakeResponse:
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.status_code = status_code
+        self.encoding = "utf-8"
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeExpensify:
+    """
+    Stands in for post(): every job's file has two rows per report in its
+     reportIDList (or one per policy in its policyIDList), in reverse
+     order. Jobs for a report in failing_reports come back with a 500.
+    """
+    def __init__(self, failing_reports=()):
+        self.failing_reports = set(failing_reports)
+        self.jobs = []
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, data, files=None, timeout=60, trace=None):
+        rjd = json.loads(data["requestJobDescription"])
+
+        if rjd["type"] == "file":
+            filters = rjd["inputSettings"]["filters"]
+            report_ids = fo_expensify.as_id_list(filters.get("reportIDList"))
+            policy_ids = fo_expensify.as_id_list(filters.get("policyIDList"))
+
+            if self.failing_reports & set(report_ids):
+                return FakeResponse('{"responseCode": 500, "responseMessage": "Something broke"}')
+
+            with self.lock:
+                self.jobs.append((report_ids, policy_ids))
+                file_name = f"exportfile{len(self.jobs)}.json"
+                self.files[file_name] = (report_ids, policy_ids)
+
+            return FakeResponse(file_name)
+
+        report_ids, policy_ids = self.files[rjd["fileName"]]
+        if report_ids:
+            rows = [{"ReportID": report_id, "Amount": amount}
+                    for report_id in report_ids for amount in (1, 2)]
+        else:
+            rows = [{"PolicyID": policy_id} for policy_id in policy_ids]
+
+        return FakeResponse(json.dumps(rows[::-1]))
+
+
+class ChunkedExportTest(unittest.TestCase):
+    def setUp(self):
+        self.kwargs = dict(start_date="2024-01-01", partnerUserID="user", partnerUserSecret="secret")
+        for patcher in (mock.patch("time.sleep"),
+                        mock.patch.object(fo_expensify, "MAX_REPORT_IDS_PER_JOB", 3),
+                        mock.patch.object(fo_expensify, "MAX_POLICY_IDS_PER_JOB", 2)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_chunked(self):
+        self.assertEqual(fo_expensify.chunked(["1", "2", "1", "3", "4", "2", "5"], 2),
+                         [["1", "2"], ["3", "4"], ["5"]])
+        self.assertEqual(fo_expensify.chunked([], 2), [])
+
+    def test_merge_exports_follows_report_ids(self):
+        results = [[{"ReportID": "3", "n": 1}, {"ReportID": "1", "n": 2}],
+                   [{"ReportID": 2, "n": 3}, {"ReportID": "1", "n": 4}, {"ReportID": "9", "n": 5}]]
+
+        rows = fo_expensify.merge_exports(results, report_ids=["1", "2", "3"])
+
+        # Reports in report_ids order, rows within a report (and unknown
+        #  reports, last) in the order Expensify had them
+        self.assertEqual([row["n"] for row in rows], [2, 4, 3, 1, 5])
+
+    def test_merge_exports_keeps_identical_rows(self):
+        row = {"ReportID": "1", "Amount": 5}
+
+        self.assertEqual(fo_expensify.merge_exports([[row], [dict(row)]]), [row, row])
+
+    def test_long_report_id_lists_are_chunked_and_merged(self):
+        expensify = FakeExpensify()
+        report_ids = ["5", "4", "3", "2", "1", "4", "6", "7"]
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            rj = fo_expensify.export_and_download_reports(report_ids=report_ids, **self.kwargs)
+
+        self.assertEqual(sorted(report_ids for report_ids, _ in expensify.jobs),
+                         [["2", "1", "6"], ["5", "4", "3"], ["7"]])
+        self.assertEqual([row["ReportID"] for row in rj],
+                         ["5", "5", "4", "4", "3", "3", "2", "2", "1", "1", "6", "6", "7", "7"])
+
+    def test_only_one_list_is_chunked(self):
+        expensify = FakeExpensify()
+        report_ids = [str(i) for i in range(9)]
+        policy_ids = [f"P{i}" for i in range(5)]
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            fo_expensify.export_and_download_reports(report_ids=report_ids, policy_ids=policy_ids,
+                                                     **self.kwargs)
+
+        # One job per report chunk, each with the whole policy filter
+        self.assertEqual(len(expensify.jobs), 3)
+        self.assertTrue(all(job_policy_ids == policy_ids for _, job_policy_ids in expensify.jobs))
+
+    def test_long_policy_id_lists_are_chunked(self):
+        expensify = FakeExpensify()
+        policy_ids = [f"P{i}" for i in range(5)]
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            rj = fo_expensify.export_and_download_reports(policy_ids=policy_ids, **self.kwargs)
+
+        self.assertEqual(len(expensify.jobs), 3)
+        self.assertEqual(sorted(row["PolicyID"] for row in rj), policy_ids)
+
+    def test_failed_chunks_keep_the_others_results(self):
+        expensify = FakeExpensify(failing_reports={"4"})
+        report_ids = [str(i) for i in range(1, 10)]
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            with self.assertRaises(fo_expensify.PartialExport) as raised:
+                fo_expensify.export_and_download_reports(report_ids=report_ids, **self.kwargs)
+
+        self.assertEqual(len(raised.exception.errors), 1)
+        self.assertIn("Something broke", str(raised.exception.errors[0]))
+        self.assertEqual([row["ReportID"] for row in raised.exception.results],
+                         ["1", "1", "2", "2", "3", "3", "7", "7", "8", "8", "9", "9"])
+
+
+if __name__ == "__main__":
+    unittest.main()
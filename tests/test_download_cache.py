@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+The download cache for closed periods, with post() faked so nothing
+ reaches Expensify.
+"""
+import json
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+import fo_expensify.fo_expensify as fo_expensify
+
+
+class FakeResponse:
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.status_code = status_code
+        self.encoding = "utf-8"
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeExpensify:
+    """
+    Stands in for post(): export jobs get a file name, downloads get the
+     download_text (rows, unless it's set to an error).
+    """
+    def __init__(self, download_text='[{"ReportID": "1", "Amount": 100}]'):
+        self.download_text = download_text
+        self.calls = 0
+
+    def __call__(self, data, files=None, timeout=60, trace=None):
+        self.calls += 1
+        rjd = json.loads(data["requestJobDescription"])
+
+        if rjd["type"] == "file":
+            return FakeResponse("exportfile.json")
+
+        return FakeResponse(self.download_text)
+
+
+class DownloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.kwargs = dict(start_date="2020-01-01", end_date="2020-01-31", cache_dir=self.cache_dir,
+                           partnerUserID="user", partnerUserSecret="secret")
+        sleep_patcher = mock.patch("time.sleep")
+        sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def cached_files(self):
+        return [name for name in os.listdir(self.cache_dir)
+                if fo_expensify.CACHE_FILE_PATTERN.match(name)]
+
+    def test_closed_period_is_served_from_cache(self):
+        expensify = FakeExpensify()
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            first = fo_expensify.export_and_download_reports(**self.kwargs)
+            self.assertEqual(expensify.calls, 2)
+
+            second = fo_expensify.export_and_download_reports(**self.kwargs)
+
+        self.assertEqual(expensify.calls, 2)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.cached_files()), 1)
+
+    def test_other_tenants_and_filters_miss(self):
+        expensify = FakeExpensify()
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            fo_expensify.export_and_download_reports(**self.kwargs)
+            fo_expensify.export_and_download_reports(**dict(self.kwargs, partnerUserID="other"))
+            fo_expensify.export_and_download_reports(**dict(self.kwargs, policy_ids="P1"))
+
+        self.assertEqual(expensify.calls, 6)
+        self.assertEqual(len(self.cached_files()), 3)
+
+    def test_open_periods_and_marks_are_never_cached(self):
+        expensify = FakeExpensify()
+        recent = str(fo_expensify.datetime.date.today())
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            for kwargs in (dict(self.kwargs, end_date=recent),
+                           dict(self.kwargs, export_mark_filter="fo")):
+                fo_expensify.export_and_download_reports(**kwargs)
+                fo_expensify.export_and_download_reports(**kwargs)
+
+        self.assertEqual(expensify.calls, 8)
+        self.assertEqual(self.cached_files(), [])
+
+    def test_error_responses_are_not_cached(self):
+        expensify = FakeExpensify(download_text='{"responseCode": 410, "responseMessage": "Gone"}')
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            rj = fo_expensify.export_and_download_reports(**self.kwargs)
+            fo_expensify.export_and_download_reports(**self.kwargs)
+
+        self.assertEqual(rj["responseCode"], 410)
+        self.assertEqual(expensify.calls, 4)
+        self.assertEqual(self.cached_files(), [])
+
+    def test_eviction_is_lru_and_leaves_other_files_alone(self):
+        other_path = os.path.join(self.cache_dir, "notes.txt")
+        with open(other_path, "wb") as other_handle:
+            other_handle.write(b"x" * 1000)
+
+        keys = [fo_expensify.cache_key({"job": i}) for i in range(3)]
+
+        for age, key in enumerate(keys):
+            fo_expensify.write_cached_download(self.cache_dir, key, "json", b"x" * 100)
+            # Oldest first, a second apart
+            path = os.path.join(self.cache_dir, f"{key}.json")
+            os.utime(path, (1000 + age, 1000 + age))
+
+        self.assertIsNotNone(fo_expensify.read_cached_download(self.cache_dir, keys[0], "json"))
+
+        fo_expensify.write_cached_download(self.cache_dir, fo_expensify.cache_key({"job": 3}), "json",
+                                           b"x" * 100, max_bytes=250)
+
+        # keys[0] was just read, so keys[1] and keys[2] are the least recently used
+        self.assertIsNotNone(fo_expensify.read_cached_download(self.cache_dir, keys[0], "json"))
+        self.assertIsNone(fo_expensify.read_cached_download(self.cache_dir, keys[1], "json"))
+        self.assertEqual(len(self.cached_files()), 2)
+        self.assertTrue(os.path.exists(other_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
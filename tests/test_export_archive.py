@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Export archives: partitioned writes, schema widening and pushed-down reads.
+"""
+import datetime
+import os
+import tempfile
+import unittest
+
+import fo_expensify.fo_expensify as fo_expensify
+
+try:
+    import pyarrow.dataset as ds
+except ImportError:
+    ds = None
+
+
+class ArchiveMonthTest(unittest.TestCase):
+    def test_dates_in_any_format(self):
+        for value in ("2024-01-05", "2024-01-05 10:30:00", "2024-01-05T10:30:00Z", "01/05/2024",
+                      "2024/01/05", "01/05/24", datetime.date(2024, 1, 5),
+                      datetime.datetime(2024, 1, 5, 10, 30)):
+            self.assertEqual(fo_expensify.archive_month(value), "2024-01", value)
+
+    def test_anything_else_is_unknown(self):
+        for value in (None, "", "soon", "2024-13-01", "../../etc", 20240105):
+            self.assertEqual(fo_expensify.archive_month(value), "unknown", value)
+
+
+@unittest.skipIf(ds is None, "Export archives need pyarrow")
+class ExportArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def part_files(self):
+        return sorted(os.path.relpath(os.path.join(directory, name), self.root)
+                      for directory, _, names in os.walk(self.root) for name in names
+                      if name.startswith("part-"))
+
+    def test_round_trip(self):
+        for file_format in fo_expensify.ARCHIVE_FORMATS:
+            root = os.path.join(self.root, file_format)
+
+            fo_expensify.archive_exports(
+                [{"PolicyID": "1", "Created": "2024-01-05", "Amount": 100, "Comment": None},
+                 {"PolicyID": "2", "Created": "01/20/2024", "Amount": 5, "Comment": None}],
+                root, "Created", policy_field="PolicyID", file_format=file_format)
+            # Ints widen to floats, all-null columns to strings, and new
+            #  columns show up (as nulls in older files)
+            fo_expensify.archive_exports(
+                [{"PolicyID": "1", "Created": "2024-02-05", "Amount": 1.5, "Comment": "hi", "New": True}],
+                root, "Created", policy_field="PolicyID", file_format=file_format)
+
+            table = fo_expensify.read_export_archive(root, file_format=file_format)
+            self.assertEqual(table.num_rows, 3)
+            self.assertEqual(str(table.schema.field("Amount").type), "double")
+            self.assertEqual(str(table.schema.field("Comment").type), "string")
+
+            rows = fo_expensify.read_export_archive(
+                root, columns=["Comment", "month"], policies="1", filter=ds.field("Amount") > 50,
+                file_format=file_format).to_pylist()
+            self.assertEqual(rows, [{"Comment": None, "month": "2024-01"}])
+
+            rows = fo_expensify.read_export_archive(
+                root, columns=["Amount", "New", "policy"], months=["2024-02"],
+                file_format=file_format).to_pylist()
+            self.assertEqual(rows, [{"Amount": 1.5, "New": True, "policy": "1"}])
+
+    def test_partitions(self):
+        fo_expensify.archive_exports(
+            [{"Created": "01/05/2024"}, {"Created": "someday"}, {"Created": "2024-03-01"}],
+            self.root, "Created", policy_id="P/1")
+
+        self.assertEqual([os.path.dirname(path) for path in self.part_files()],
+                         [os.path.join("policy=P_1", "month=2024-01"),
+                          os.path.join("policy=P_1", "month=2024-03"),
+                          os.path.join("policy=P_1", "month=unknown")])
+
+    def test_bad_rows_are_refused(self):
+        fo_expensify.archive_exports([{"Created": "2024-01-05", "Amount": 1}], self.root, "Created",
+                                     policy_id="P1")
+
+        for rows in ([{"Created": "2024-01-05", "Amount": "lots"}],
+                     [{"Created": "2024-01-05", "month": "January"}],
+                     [{"Created": "2024-01-05", "policy": "P2"}]):
+            with self.assertRaises(Exception):
+                fo_expensify.archive_exports(rows, self.root, "Created", policy_id="P1")
+
+        # ...without breaking the archive
+        self.assertEqual(len(self.part_files()), 1)
+        self.assertEqual(fo_expensify.read_export_archive(self.root).column_names,
+                         ["Created", "Amount", "policy", "month"])
+
+    def test_partition_fields_are_required(self):
+        with self.assertRaises(Exception):
+            fo_expensify.archive_exports([{"Created": "2024-01-05"}], self.root, "Created")
+
+        self.assertEqual(fo_expensify.archive_exports([], self.root, "Created", policy_id="P1"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
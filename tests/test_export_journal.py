@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+The export journal, with post() faked so nothing reaches Expensify.
+"""
+import json
+import os
+import tempfile
+import unittest
+
+from unittest import mock
+
+import requests
+
+import fo_expensify.fo_expensify as fo_expensify
+
+
+class FakeResponse:
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.status_code = status_code
+        self.encoding = "utf-8"
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeExpensify:
+    """
+    Stands in for post(): export jobs get a new file name, downloads get
+     the file's rows. Either can be made to fail.
+    """
+    def __init__(self, export_error=None, download_error=None):
+        self.export_error = export_error
+        self.download_error = download_error
+        self.exports = 0
+        self.downloads = 0
+
+    def __call__(self, data, files=None, timeout=60, trace=None):
+        rjd = json.loads(data["requestJobDescription"])
+
+        if rjd["type"] == "file":
+            self.exports += 1
+            if self.export_error:
+                raise self.export_error
+            return FakeResponse(f"exportfile{self.exports}.json")
+
+        self.downloads += 1
+        if self.download_error:
+            raise self.download_error
+        return FakeResponse(json.dumps([{"ReportID": "1", "File": rjd["fileName"]}]))
+
+
+class ExportJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.journal_path = os.path.join(tempfile.mkdtemp(), "exports.jsonl")
+        self.kwargs = dict(start_date="2024-01-01", export_mark="fo", journal_path=self.journal_path,
+                           partnerUserID="user", partnerUserSecret="secret")
+        sleep_patcher = mock.patch("time.sleep")
+        sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_crash_after_exported_costs_one_download(self):
+        expensify = FakeExpensify(download_error=RuntimeError("process died"))
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            with self.assertRaises(RuntimeError):
+                fo_expensify.export_and_download_reports(**self.kwargs)
+
+            # Retries re-downloaded, but never re-exported
+            self.assertEqual(expensify.exports, 1)
+
+            expensify.download_error = None
+            results = fo_expensify.resume_pending_downloads(self.journal_path, partnerUserID="user")
+
+        self.assertEqual(list(results.values()), [[{"ReportID": "1", "File": "exportfile1.json"}]])
+        self.assertEqual(expensify.exports, 1)
+        self.assertEqual({job["state"] for job in fo_expensify.read_journal(self.journal_path).values()},
+                         {"done"})
+
+    def test_rerun_after_exported_resumes_download(self):
+        expensify = FakeExpensify(download_error=RuntimeError("process died"))
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            with self.assertRaises(RuntimeError):
+                fo_expensify.export_and_download_reports(**self.kwargs)
+
+            expensify.download_error = None
+            rj = fo_expensify.export_and_download_reports(**self.kwargs)
+
+        self.assertEqual(rj, [{"ReportID": "1", "File": "exportfile1.json"}])
+        self.assertEqual(expensify.exports, 1)
+
+    def test_timeout_after_submitted_refuses_to_export_again(self):
+        expensify = FakeExpensify(export_error=requests.exceptions.Timeout())
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            with self.assertRaises(fo_expensify.MarkStateUnknown):
+                fo_expensify.export_and_download_reports(**self.kwargs)
+
+            # The retry saw the submitted job rather than exporting again
+            self.assertEqual(expensify.exports, 1)
+
+            expensify.export_error = None
+            with self.assertRaises(fo_expensify.MarkStateUnknown):
+                fo_expensify.export_and_download_reports(**self.kwargs)
+
+            self.assertEqual(expensify.exports, 1)
+
+            with mock.patch("builtins.print") as printed:
+                results = fo_expensify.resume_pending_downloads(self.journal_path, partnerUserID="user")
+
+        self.assertEqual(results, {})
+        self.assertIn("never returned a file name", printed.call_args[0][0])
+
+        (job,) = fo_expensify.read_journal(self.journal_path).values()
+        self.assertEqual(job["state"], "submitted")
+
+    def tear_journal(self):
+        with open(self.journal_path, "a") as journal_handle:
+            journal_handle.write('{"job": "abc", "sta')
+
+    def test_torn_line_is_ignored(self):
+        fo_expensify.append_journal(self.journal_path, job="abc", state="exported", file_name="f.json")
+        self.tear_journal()
+
+        self.assertEqual(fo_expensify.read_journal(self.journal_path)["abc"]["state"], "exported")
+
+        # The next record isn't lost with it
+        fo_expensify.append_journal(self.journal_path, job="def", state="submitted")
+
+        jobs = fo_expensify.read_journal(self.journal_path)
+        self.assertEqual(jobs["abc"]["state"], "exported")
+        self.assertEqual(jobs["def"]["state"], "submitted")
+
+    def test_torn_line_before_a_job_still_resumes(self):
+        self.tear_journal()
+        expensify = FakeExpensify(download_error=RuntimeError("process died"))
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            with self.assertRaises(RuntimeError):
+                fo_expensify.export_and_download_reports(**self.kwargs)
+
+            expensify.download_error = None
+            results = fo_expensify.resume_pending_downloads(self.journal_path, partnerUserID="user")
+
+        self.assertEqual(list(results.values()), [[{"ReportID": "1", "File": "exportfile1.json"}]])
+        self.assertEqual(expensify.exports, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+The policy index and bulk expense validator, with post() faked so nothing
+ reaches Expensify.
+"""
+import json
+import threading
+import unittest
+
+from unittest import mock
+
+import fo_expensify.fo_expensify as fo_expensify
+
+
+POLICY = {
+    "categories": [{"name": "Travel", "enabled": True},
+                   {"name": "Meals", "enabled": False}],
+    "tags": [{"name": "Region", "tags": [{"name": "East"}, {"name": "West"}]},
+             {"name": "Team", "tags": [{"name": "Sales"}, {"name": "R\\:D"},
+                                       {"name": "Ops", "enabled": False}]}],
+    "reportFields": [{"name": "Project", "values": ["Alpha", "Beta"]},
+                     {"name": "Notes", "values": []}],
+    "tax": {"default": "GST", "rates": [{"rateID": "GST", "name": "GST 5%"}]},
+}
+
+
+def dependent_policy(tags):
+    return dict(POLICY, tags=[{"name": "Region", "tags": [{"name": "East"}, {"name": "West"}]},
+                              {"name": "Team", "tags": tags}])
+
+
+class FakeResponse:
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.content = text.encode("utf-8")
+        self.status_code = status_code
+        self.encoding = "utf-8"
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class FakeExpensify:
+    """
+    Stands in for post(): policy getters get POLICY for each policy ID.
+    """
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def __call__(self, data, files=None, timeout=60, trace=None):
+        policy_ids = json.loads(data["requestJobDescription"])["inputSettings"]["policyIDList"]
+
+        with self.lock:
+            self.batches.append(policy_ids)
+
+        return FakeResponse(json.dumps({"policyInfo": {policy_id: POLICY for policy_id in policy_ids}}))
+
+
+class PolicyIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = fo_expensify.PolicyIndex({"P1": POLICY})
+
+    def test_lookups(self):
+        self.assertEqual(self.index.category("P1", "Travel")["name"], "Travel")
+        self.assertIsNone(self.index.category("P1", "Lodging"))
+        self.assertEqual(self.index.tax_rate("P1", None)["name"], "GST 5%")
+        self.assertEqual(self.index.tax_rate("P1", "GST 5%")["rateID"], "GST")
+        self.assertTrue(self.index.report_field_allows("P1", "Project", "Alpha"))
+        self.assertFalse(self.index.report_field_allows("P1", "Project", "Gamma"))
+        self.assertTrue(self.index.report_field_allows("P1", "Notes", "anything"))
+
+    def test_independent_tags(self):
+        self.assertEqual([tag["name"] for tag in self.index.tags("P1", "West:Sales")], ["West", "Sales"])
+        # Literal colons, as cleansed exports carry them
+        self.assertEqual(len(self.index.tags("P1", "East:R|||||D")), 2)
+        self.assertIsNone(self.index.tags("P1", "East:Marketing"))
+        self.assertIsNone(self.index.tags("P1", "Sales"))
+
+    def test_trailing_blank_levels_are_dropped(self):
+        self.assertEqual(fo_expensify.tag_segments("East:"), ["East"])
+        self.assertEqual(self.index.tags("P1", "East:"), self.index.tags("P1", "East"))
+
+    def test_dependent_tags_by_full_path(self):
+        index = fo_expensify.PolicyIndex({"P1": dependent_policy(
+            [{"name": "East:Sales"}, {"name": "West:Ops"}])})
+
+        self.assertIsNotNone(index.tags("P1", "East:Sales"))
+        self.assertIsNone(index.tags("P1", "East:Ops"))
+        self.assertIsNotNone(index.tags("P1", "West:Ops"))
+
+    def test_dependent_tags_by_parent_key(self):
+        index = fo_expensify.PolicyIndex({"P1": dependent_policy(
+            [{"name": "Sales", "parentTagName": "East"}, {"name": "Sales", "parent": "West"},
+             {"name": "Ops", "parentTag": "West"}])})
+
+        self.assertIsNotNone(index.tags("P1", "East:Sales"))
+        self.assertIsNotNone(index.tags("P1", "West:Sales"))
+        self.assertIsNone(index.tags("P1", "East:Ops"))
+
+    def test_unresolvable_dependent_tags_raise(self):
+        index = fo_expensify.PolicyIndex({
+            "P1": dependent_policy([{"name": "Sales", "parentTagID": "tag_123"}]),
+            "P2": dict(POLICY, tags=[dict(POLICY["tags"][0]), dict(POLICY["tags"][1], dependent=True)]),
+        })
+
+        for policy_id in ("P1", "P2"):
+            with self.assertRaises(fo_expensify.DependentTagsUnresolved):
+                index.tags(policy_id, "East:Sales")
+
+        # ...without taking the rest of the policy down with them
+        self.assertIsNotNone(index.category("P1", "Travel"))
+
+
+class ValidateExpensesTest(unittest.TestCase):
+    def test_problems_are_reported(self):
+        index = fo_expensify.PolicyIndex({
+            "P1": POLICY,
+            "P2": dict(POLICY, tags=[dict(POLICY["tags"][0]), dict(POLICY["tags"][1], isDependent=True)]),
+        })
+        expenses = [
+            {"PolicyID": "P1", "Category": "Travel", "Tag": "East:Sales", "Project": "Alpha"},
+            {"PolicyID": "P1", "Category": "Meals", "Tag": "East:Ops", "Project": ["Alpha", "Gamma"]},
+            {"PolicyID": "P1", "Category": "Lodging", "Tag": "North", "Tax": "VAT"},
+            {"PolicyID": "P1", "Category": "", "Tag": None, "Project": {"nested": "value"}},
+            {"PolicyID": "P2", "Category": "Travel", "Tag": "East:Sales"},
+            {"PolicyID": "P9", "Category": "Travel"},
+            {"Category": "Travel", "Tag": "West:"},
+        ]
+
+        problems = list(fo_expensify.validate_expenses(expenses, index, policy_id="P1", tax_field="Tax",
+                                                       report_fields=["Project"]))
+
+        self.assertEqual(problems, [
+            (1, "Category", "Meals", "disabled category"),
+            (1, "Tag", "East:Ops", "disabled tag"),
+            (1, "Project", "Gamma", "invalid report field value"),
+            (2, "Category", "Lodging", "unknown category"),
+            (2, "Tag", "North", "unknown tag"),
+            (2, "Tax", "VAT", "unknown tax rate"),
+            (4, "Tag", "East:Sales", "dependent tags can't be validated"),
+            (5, "PolicyID", "P9", "unknown policy"),
+        ])
+
+
+class BuildPolicyIndexTest(unittest.TestCase):
+    def test_policies_are_fetched_in_batches(self):
+        expensify = FakeExpensify()
+        policy_ids = [f"P{i}" for i in range(7)]
+
+        with mock.patch.object(fo_expensify, "post", expensify):
+            index = fo_expensify.build_policy_index(policy_ids + ["P0"], batch_size=3,
+                                                    partnerUserID="user", partnerUserSecret="secret")
+
+        self.assertEqual(sorted(expensify.batches), [["P0", "P1", "P2"], ["P3", "P4", "P5"], ["P6"]])
+        self.assertEqual(sorted(index.policies), policy_ids)
+        self.assertIsNotNone(index.tags("P6", "West:Sales"))
+
+
+if __name__ == "__main__":
+    unittest.main()